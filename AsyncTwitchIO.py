@@ -0,0 +1,283 @@
+# asyncio variant of TwitchIO for running many transfers on one event loop.
+# Needs the optional aiohttp package.
+
+from contextlib import nullcontext
+from io import IOBase
+import asyncio
+import collections
+import json
+import logging
+import threading
+import time
+import aiohttp
+import requests
+
+import TwitchIO
+import twitch_playlist
+import metrics
+import retry
+from segment_cache import SegmentCache
+from segment_index import parse_sizes
+
+
+# Status, headers and body of a finished request
+Response = collections.namedtuple('Response', ['status_code', 'headers', 'content'])
+
+async def request(session, method, uri, params=None, headers=None, timeout=12.1):
+	# Send a single request with the aiohttp session and return a Response.
+	# aiohttp errors are turned into the matching requests exceptions so RetryPolicy can classify them.
+	# Like the timeout of requests, timeout limits connecting and every read but not the whole download,
+	# which takes longer when many transfers share the link.
+	try:
+		async with session.request(method.upper(), uri, params=params, headers=headers, timeout=aiohttp.ClientTimeout(sock_connect=timeout, sock_read=timeout)) as response:
+			result = Response(response.status, response.headers, await response.read())
+	except asyncio.TimeoutError as e:
+		raise requests.exceptions.Timeout(e)
+	except aiohttp.ClientPayloadError as e:
+		raise requests.exceptions.ChunkedEncodingError(e)
+	except aiohttp.ClientError as e:
+		raise requests.exceptions.ConnectionError(e)
+	if result.status_code >= 400:
+		raise requests.exceptions.HTTPError('{} error for url {}'.format(result.status_code, uri), response=result)
+	return result
+
+async def get_session(session, video_id, headers=dict()):
+	r = await request(session, 'get', twitch_playlist.twitch_api_url + "/api/vods/{}/access_token".format(video_id), headers=headers)
+	logging.debug("get_session for video_id {} got data {}".format(video_id, r.content))
+	data = json.loads(r.content)
+	return (data['token'], data['sig'])
+
+async def get_variant_playlist(session, video_id, headers=dict()):
+	token, sig = await get_session(session, video_id, headers)
+	r = await request(session, 'get', twitch_playlist.twitch_usher_url + "/vod/{}".format(video_id), params=twitch_playlist.variant_playlist_params(token, sig))
+	logging.debug('get_variant_playlist for video_id {} got data {}'.format(video_id, r.content))
+	return twitch_playlist.parse_variant_playlist(r.content.decode('utf-8'))
+
+async def get_source_playlist(session, video_id, headers=dict()):
+	variant_playlist = await get_variant_playlist(session, video_id, headers)
+	uri = twitch_playlist.source_playlist_uri(variant_playlist)
+	if uri is None:
+		return None
+	r = await request(session, 'get', uri)
+	logging.info('get_source_playlist found source playlist for video_id {} at {}'.format(video_id, uri))
+	logging.debug('get_source_playlist source playlist data is {}'.format(r.content))
+	return twitch_playlist.parse_source_playlist(r.content.decode('utf-8'), uri)
+
+# PrefetchWindow for AsyncTwitchIO that downloads in tasks on the event loop
+class Prefetcher(TwitchIO.PrefetchWindow):
+	def submit(self, index):
+		task = asyncio.ensure_future(self.twitchio.download_chunk(index))
+		# errors of chunks that are never read should not be reported as unretrieved
+		task.add_done_callback(lambda task: task.cancelled() or task.exception())
+		return task
+
+# The same view of a Twitch video as TwitchIO but every method that sends requests is a coroutine,
+# so one event loop can drive many transfers without a thread for each of them.
+# Index building, prefetching and retries work like in TwitchIO, byte range fetches after seeks are not done.
+# session is an aiohttp.ClientSession and download_slots an optional asyncio.Semaphore shared with other
+# transfers on the same loop that limits the number of concurrent downloads.
+# The constructor does not build the index, use from_twitch or await build_index.
+class AsyncTwitchIO:
+	def __init__(self, segments, session, prefetch=0, prefetch_memory=256*2**20, cache=None, timeout=12.1, download_slots=None, retry_policy=None):
+		self.segments = segments
+		self.session = session
+		self.download_slots = download_slots
+		self.timeout = timeout
+		self.retry_policy = retry_policy if retry_policy is not None else retry.default_policy
+		self.position = 0
+		self.index = None
+		self.sequential = True
+		# The last chunk read as (index, data), like in TwitchIO
+		self.current = None
+		self.cache = cache if cache is not None else SegmentCache()
+		self.prefetch = prefetch
+		self.prefetch_memory = prefetch_memory
+		self.prefetcher = Prefetcher(self, prefetch, prefetch_memory) if prefetch > 0 else None
+	async def from_twitch(video_id, session, headers=dict(), index_store=None, index_workers=16, **kwargs):
+		# Like TwitchIO.from_twitch, kwargs are passed on to the AsyncTwitchIO constructor
+		if index_store is not None:
+			index = index_store.load(video_id)
+			if index is not None:
+				segments, sizes = index
+				twitchio = AsyncTwitchIO(segments, session, **kwargs)
+				twitchio.set_index(sizes)
+				if await twitchio.segment_available(0):
+					logging.info('Loaded index of video {} with {} segments from the index store'.format(video_id, len(segments)))
+					return twitchio
+				logging.info('Segments of the stored index of video {} are gone, building it again'.format(video_id))
+				index_store.invalidate(video_id)
+				twitchio.close()
+		playlist = await get_source_playlist(session, video_id, headers)
+		twitchio = AsyncTwitchIO(playlist.segments, session, **kwargs)
+		await twitchio.build_index(index_workers)
+		if index_store is not None and playlist.is_endlist:
+			index_store.save(video_id, twitchio.segments, twitchio.get_chunk_sizes())
+		return twitchio
+	# The index, the split planning and seeking do not send requests and are shared with TwitchIO
+	set_index = TwitchIO.TwitchIO.set_index
+	offset_index = TwitchIO.TwitchIO.offset_index
+	time_index = TwitchIO.TwitchIO.time_index
+	size = TwitchIO.TwitchIO.size
+	duration = TwitchIO.TwitchIO.duration
+	plan_parts = TwitchIO.TwitchIO.plan_parts
+	get_index_for_offset = TwitchIO.TwitchIO.get_index_for_offset
+	get_chunk_size = TwitchIO.TwitchIO.get_chunk_size
+	get_chunk_sizes = TwitchIO.TwitchIO.get_chunk_sizes
+	seek = TwitchIO.TwitchIO.seek
+	plan_read = TwitchIO.TwitchIO.plan_read
+	def part(self, first, last):
+		# Return an AsyncTwitchIO for the segments [first, last) that shares session, cache and settings with this one
+		return AsyncTwitchIO(self.segments[first:last], self.session, prefetch=self.prefetch, prefetch_memory=self.prefetch_memory, cache=self.cache, timeout=self.timeout, download_slots=self.download_slots, retry_policy=self.retry_policy)
+	def split_parts(self, max_size=None, max_duration=None, plan=None):
+		if plan is None:
+			plan = self.plan_parts(max_size, max_duration)
+		for part in plan:
+			yield self.part(part.first, part.last)
+	async def build_index(self, workers=16):
+		# Segments without offsets in their uri get their size from up to workers concurrent head requests
+		uris = [segment.uri for segment in self.segments]
+		sizes = parse_sizes(uris)
+		missing = [i for i, size in enumerate(sizes) if size is None]
+		if len(missing) > 0:
+			logging.info('Sending {} head requests to build the index'.format(len(missing)))
+			slots = asyncio.Semaphore(workers)
+			async def head(index):
+				async with slots:
+					return await self.head_chunk_size(uris[index])
+			for i, size in zip(missing, await asyncio.gather(*[head(i) for i in missing])):
+				sizes[i] = size
+		self.set_index(sizes)
+	async def segment_available(self, index):
+		# Like TwitchIO.segment_available
+		if index >= len(self.segments):
+			return True
+		uri = self.segments.uri(index)
+		try:
+			await self.retry_policy.call_async(lambda: self.request('head', uri), uri, 'HEAD chunk {}'.format(uri), 'head')
+		except requests.exceptions.HTTPError:
+			return False
+		return True
+	async def head_chunk_size(self, uri):
+		response = await self.retry_policy.call_async(lambda: self.request('head', uri), uri, 'HEAD chunk {}'.format(uri), 'head')
+		return int(response.headers['Content-Length'])
+	async def request(self, method, uri, headers=None):
+		# Send a single request and record its latency and throughput
+		start = time.monotonic()
+		async with (self.download_slots if method == 'get' and self.download_slots is not None else nullcontext()):
+			response = await request(self.session, method, uri, headers=headers, timeout=self.timeout)
+		elapsed = time.monotonic() - start
+		metrics.registry.observe('twitch_request_seconds', elapsed, method=method)
+		if method == 'get':
+			metrics.registry.increment('twitch_downloaded_bytes_total', len(response.content))
+			metrics.registry.observe('twitch_segment_bytes_per_second', len(response.content) / max(elapsed, 1e-6))
+		return response
+	async def download_chunk(self, index):
+		# Like TwitchIO.download_chunk a chunk whose size does not match the index is downloaded again
+		uri = self.segments[index].uri
+		async def download():
+			response = await self.request('get', uri)
+			return TwitchIO.check_length(response.content, self.get_chunk_size(index))
+		return await self.retry_policy.call_async(download, uri, 'download chunk {}'.format(index), 'get')
+	async def read_chunk(self, index):
+		uri = self.segments[index].uri
+		chunk = self.cache.get(uri)
+		if chunk is not None:
+			return chunk
+		task = None
+		if self.prefetcher is not None:
+			task = self.prefetcher.take(index)
+			self.prefetcher.advance(index)
+		chunk = await task if task is not None else await self.download_chunk(index)
+		self.cache.put(uri, chunk)
+		return chunk
+	def tell(self):
+		return self.position
+	async def read(self, size=-1):
+		assert(size == -1 or size >= 0)
+		end_position = self.size if size == -1 else min(self.position + size, self.size)
+		result = bytearray(max(end_position - self.position, 0))
+		await self.readinto(result)
+		return result
+	async def readinto(self, buffer):
+		view = memoryview(buffer).cast('B')
+		written = 0
+		for index, chunk_pos, number_of_bytes_to_read in self.plan_read(len(view)):
+			self.index = index
+			if self.current is None or self.current[0] != index:
+				self.current = (index, await self.read_chunk(index))
+			chunk = self.current[1]
+			view[written:written + number_of_bytes_to_read] = memoryview(chunk)[chunk_pos:chunk_pos + number_of_bytes_to_read]
+			written += number_of_bytes_to_read
+			self.position += number_of_bytes_to_read
+		self.sequential = True
+		return written
+	def close(self):
+		if self.prefetcher is not None:
+			self.prefetcher.close()
+
+# Runs an event loop on a background thread together with the aiohttp session and download slots
+# that all AsyncTwitchIOs on it share. limit is the maximum number of open connections,
+# max_downloads optionally limits the number of concurrent chunk downloads.
+class EventLoopThread:
+	def __init__(self, limit=100, limit_per_host=32, max_downloads=None):
+		self.loop = asyncio.new_event_loop()
+		self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+		self.thread.start()
+		async def create():
+			session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host))
+			slots = asyncio.Semaphore(max_downloads) if max_downloads else None
+			return session, slots
+		self.session, self.download_slots = self.run(create())
+	def run(self, coroutine):
+		# Run coroutine on the loop and wait for its result from another thread
+		return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+	def close(self):
+		self.run(self.session.close())
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.thread.join()
+
+# Blocking IOBase on top of an AsyncTwitchIO whose loop runs in an EventLoopThread,
+# so it can be used everywhere a TwitchIO can, for example with MediaIoBaseUpload.
+class SyncTwitchIO(IOBase):
+	def __init__(self, twitchio, loop_thread):
+		self.twitchio = twitchio
+		self.loop_thread = loop_thread
+	def from_twitch(video_id, loop_thread, headers=dict(), index_store=None, **kwargs):
+		# kwargs are passed on to AsyncTwitchIO.from_twitch
+		kwargs.setdefault('download_slots', loop_thread.download_slots)
+		return SyncTwitchIO(loop_thread.run(AsyncTwitchIO.from_twitch(video_id, loop_thread.session, headers, index_store, **kwargs)), loop_thread)
+	@property
+	def size(self):
+		return self.twitchio.size
+	@property
+	def duration(self):
+		return self.twitchio.duration
+	def plan_parts(self, max_size=None, max_duration=None, balanced=True):
+		return self.twitchio.plan_parts(max_size, max_duration, balanced)
+	def split_parts(self, max_size=None, max_duration=None, plan=None):
+		for part in self.twitchio.split_parts(max_size, max_duration, plan):
+			yield SyncTwitchIO(part, self.loop_thread)
+	def seek(self, offset, whence=0):
+		return self.loop_thread.run(self.seek_async(offset, whence))
+	async def seek_async(self, offset, whence):
+		# Prefetch tasks are cancelled by seek so it has to run on the loop
+		return self.twitchio.seek(offset, whence)
+	def read(self, size=-1):
+		return self.loop_thread.run(self.twitchio.read(size))
+	def readinto(self, buffer):
+		return self.loop_thread.run(self.twitchio.readinto(buffer))
+	def seekable(self):
+		return True
+	def readable(self):
+		return True
+	def tell(self):
+		return self.twitchio.tell()
+	def writeable(self):
+		return False
+	def close(self):
+		# also called on garbage collection, possibly after the loop was stopped
+		if not self.closed and getattr(self, 'loop_thread', None) is not None and self.loop_thread.loop.is_running():
+			self.loop_thread.run(self.close_async())
+		super().close()
+	async def close_async(self):
+		self.twitchio.close()
@@ -1,107 +1,304 @@
 # Implement IOBase for a Twitch video
 
 from io import IOBase
-import bisect
-import twitch_downloader
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+import collections
+import twitch_playlist
+import metrics
+import http_pool
+import retry
+from segment_cache import SegmentCache
+from segment_index import SegmentIndex, parse_sizes
 import requests
 import time
 import logging
 import sys
 
 
-# TODO can make a bit faster by also caching the next chunk early in a seperate thread
+def parse_offsets(uri):
+	# Return the inclusive (start_offset, end_offset) byte range from the query of a segment uri
+	# or None if the uri does not contain one
+	parameters = uri[uri.rfind('?')+1:]
+	parameters = parameters.split('&')
+	keyvalues = dict()
+	for i in parameters:
+		try:
+			(key, value) = i.split('=')
+			keyvalues[key] = int(value)
+		except ValueError as e:
+			continue
+	if 'start_offset' in keyvalues and 'end_offset' in keyvalues:
+		return (keyvalues['start_offset'], keyvalues['end_offset'])
+	return None
+
+def replace_offsets(uri, start_offset, end_offset):
+	# Return uri with its start_offset and end_offset query parameters replaced
+	base, _, query = uri.rpartition('?')
+	parameters = list()
+	for parameter in query.split('&'):
+		key = parameter.split('=')[0]
+		if key == 'start_offset':
+			parameter = 'start_offset={}'.format(start_offset)
+		elif key == 'end_offset':
+			parameter = 'end_offset={}'.format(end_offset)
+		parameters.append(parameter)
+	return base + '?' + '&'.join(parameters)
+
+def check_length(content, expected):
+	# Return content or raise a retryable error if it is not expected bytes long,
+	# a truncated chunk would not fit at its offset in the video
+	if len(content) != expected:
+		raise requests.exceptions.ContentDecodingError('Expected {} bytes but got {}'.format(expected, len(content)))
+	return content
+
+# A part of a SplitPlan covering the segments [first, last)
+PlannedPart = collections.namedtuple('PlannedPart', ['first', 'last', 'size', 'duration'])
+
+# The parts a TwitchIO will be split in, can be inspected before any bytes are transferred
+class SplitPlan:
+	def __init__(self, parts):
+		self.parts = parts
+	def __len__(self):
+		return len(self.parts)
+	def __iter__(self):
+		return iter(self.parts)
+	def describe(self):
+		lines = list()
+		for i, part in enumerate(self.parts):
+			lines.append('part {}: segments {} to {}, {} bytes, {:.1f} seconds'.format(i + 1, part.first, part.last - 1, part.size, part.duration))
+		return '\n'.join(lines)
+
+# Keeps the next segments of a reader downloading while the current one is being read.
+# Fetches are started in offset_index order and the combined size of all segments that are queued,
+# downloading or downloaded but not yet read is kept below max_bytes.
+# When the reader jumps somewhere else the queued fetches that are no longer needed are cancelled.
+# Subclasses implement submit to start the download of a chunk and return a future for it.
+class PrefetchWindow:
+	def __init__(self, twitchio, count, max_bytes):
+		self.twitchio = twitchio
+		self.count = count
+		self.max_bytes = max_bytes
+		# index -> (future, size), ordered by index
+		self.pending = collections.OrderedDict()
+		self.pending_bytes = 0
+	def take(self, index):
+		# Return the future of the chunk if it was prefetched, otherwise None
+		if index not in self.pending:
+			return None
+		future, size = self.pending.pop(index)
+		self.pending_bytes -= size
+		if future.cancelled():
+			return None
+		return future
+	def discard(self, first, last):
+		# Cancel everything outside of the window [first, last]
+		for index in [i for i in self.pending if i < first or i > last]:
+			future, size = self.pending.pop(index)
+			future.cancel()
+			self.pending_bytes -= size
+	def advance(self, index):
+		# index is the chunk currently being read, keep the following ones in flight
+		last = min(index + self.count, len(self.twitchio.segments) - 1)
+		self.discard(index + 1, last)
+		for i in range(index + 1, last + 1):
+			if i in self.pending or self.twitchio.segments[i].uri in self.twitchio.cache:
+				continue
+			size = self.twitchio.get_chunk_size(i)
+			if self.pending_bytes + size > self.max_bytes:
+				break
+			self.pending[i] = (self.submit(i), size)
+			self.pending_bytes += size
+	def close(self):
+		self.discard(0, -1)
+
+# PrefetchWindow for TwitchIO that downloads on a thread pool
+class Prefetcher(PrefetchWindow):
+	def __init__(self, twitchio, count, max_bytes, workers=None):
+		super().__init__(twitchio, count, max_bytes)
+		self.executor = ThreadPoolExecutor(max_workers=workers or count)
+	def submit(self, index):
+		return self.executor.submit(self.twitchio.download_chunk, index)
+	def close(self):
+		super().close()
+		self.executor.shutdown(wait=False)
 
 # This class provides an IOBase interface to a Twitch video
 # This means the contents of the video can be accessed like a file with reading and seeking.
 # To achieve it we parse the urls in the playlist
-# and keep lists of which chunk contains what byte offset (and video duration).
-# With that list we know the total size of the video and can map an offset to a chunk via bisecting the list.
-# The class always caches the last used chunk.
+# and keep a SegmentIndex of which chunk contains what byte offset (and video duration).
+# With that index we know the total size of the video and can map an offset to a chunk via bisecting it.
+# Downloaded chunks are kept in a SegmentCache which always holds at least the last used chunk.
+# Optionally the following chunks are downloaded in the background by a Prefetcher.
+# Reads after a seek that only need a small part of a chunk, or its end, download just that byte range.
 
 # The class was created to allow videos to be downloaded from twitch and uploaded to youtube
 # without needing to keep the whole files on disk.
 class TwitchIO(IOBase):
-	def __init__(self, segments, build_index=True):
+	def __init__(self, segments, build_index=True, prefetch=0, prefetch_memory=256*2**20, cache=None, index_workers=16, timeout=12.1, limiter=None, session=None, download_slots=None, range_fraction=0.25, retry_policy=None):
+		# prefetch is the number of chunks after the current one that are downloaded in the background
+		# prefetch_memory is the maximum number of bytes those chunks may take up
+		# cache is the SegmentCache used for downloaded chunks, by default a new one is created
+		# index_workers is the number of concurrent head requests used to build the index
+		# timeout is the timeout in seconds of every request
+		# limiter is an optional BandwidthLimiter shared with other transfers that downloaded chunks are counted against
+		# session is the requests.Session to use, by default the shared one from http_pool
+		# download_slots is an optional semaphore shared with other transfers that limits the number of concurrent downloads
+		# range_fraction controls when only a byte range of a chunk is downloaded, see plan_fetch. None disables it.
+		# retry_policy is the RetryPolicy for failed requests, by default retry.default_policy
 		self.segments = segments
-		self.session = requests.Session()
+		self.session = session if session is not None else http_pool.shared_session()
+		self.download_slots = download_slots
+		self.timeout = timeout
+		self.retry_policy = retry_policy if retry_policy is not None else retry.default_policy
+		self.limiter = limiter
 		if build_index:
-			self.build_index()
+			self.build_index(index_workers)
 		self.position = 0
 		self.index = None
-		# Cache of last downloaded chunk
-		self.last_chunk_index = None
-		self.last_chunk = None
-	def from_twitch(video_id, headers=dict()):
+		self.cache = cache if cache is not None else SegmentCache()
+		self.prefetch = prefetch
+		self.prefetch_memory = prefetch_memory
+		self.prefetcher = Prefetcher(self, prefetch, prefetch_memory) if prefetch > 0 else None
+		self.range_fraction = range_fraction
+		# The last byte range downloaded as (index, start within the chunk, data)
+		self.partial = None
+		# The last whole chunk read as (index, data), so small reads do not look it up in the cache every time
+		self.current = None
+		# Whether the next read continues where the last one ended
+		self.sequential = True
+	def from_twitch(video_id, headers=dict(), index_store=None, **kwargs):
 		# video_id is just a string of numbers and does not start with a v
-		return TwitchIO(twitch_downloader.get_source_playlist(video_id, headers).segments)
-	def split_parts(self, max_size=None, max_duration=None):
-		size = 0
-		duration = 0.0
-		offset_index = list()
-		time_index = list()
-		segments = list()
-		def create_part():
-			part = TwitchIO(segments, build_index=False)
-			part.size = size
-			part.duration = duration
-			part.offset_index = offset_index
-			part.time_index = time_index
-			return part
-		for i, segment in enumerate(self.segments):
-			current_size = self.offset_index[i] - (self.offset_index[i-1] if i > 0 else 0)
-			current_duration = self.time_index[i] - (self.time_index[i-1] if i > 0 else 0)
-			# if a part cannot grow anymore but has at least one segment
-			if len(segments) > 0:
-				if (max_size != None and size + current_size > max_size) or (max_duration != None and duration + current_duration > max_duration):
-					yield create_part()
-					# reset values for next part
-					size = 0
-					duration = 0.0
-					offset_index = list()
-					time_index = list()
-					segments = list()
-			segments.append(segment)
-			size += current_size
-			duration += current_duration
-			offset_index.append(size)
-			time_index.append(duration)
-		yield create_part()
-	def build_index(self):
-		self.offset_index = list()
-		self.size = 0
-		self.time_index = list()
-		self.duration = 0.0
-		for segment in self.segments:
-			# Some older vods dont have start and end offsets in the playlist
-			# so for those we need to send head requests to get the chunk size
-			uri = segment.uri
-			parameters = uri[uri.rfind('?')+1:]
-			parameters = parameters.split('&')
-			keyvalues = dict()
-			for i in parameters:
-				try:
-					(key, value) = i.split('=')
-					keyvalues[key] = int(value)
-				except ValueError as e:
-					continue
-			if 'start_offset' in keyvalues and 'end_offset' in keyvalues:
-				self.size += keyvalues['end_offset'] - keyvalues['start_offset'] + 1 # + 1 because those ranges are inclusive
-			else:
-				while True:
-					try:
-						response = self.session.head(segment.uri, timeout=12.1)
-						response.raise_for_status()
-						size = int(response.headers['Content-Length'])
-						self.size += size
-						break
-					except (requests.exceptions.RequestException, requests.exceptions.HTTPError) as e:
-						logging.warning('Encounted following exception while trying to HEAD chunk {} {}'.format(segment.uri, e))
-						time.sleep(12.1)
-						continue
-			duration = segment.duration
-			self.offset_index.append(self.size)
-			self.duration += duration
-			self.time_index.append(self.duration)
+		# If index_store is given the index is loaded from and saved to it. The index is only saved
+		# once the playlist is complete, a video that is still recording would otherwise stay truncated.
+		# A loaded index is checked with a head request for its first segment and built again if Twitch moved the segments.
+		# kwargs are passed on to the TwitchIO constructor
+		if index_store is not None:
+			index = index_store.load(video_id)
+			if index is not None:
+				segments, sizes = index
+				twitchio = TwitchIO(segments, build_index=False, **kwargs)
+				twitchio.set_index(sizes)
+				if twitchio.segment_available(0):
+					logging.info('Loaded index of video {} with {} segments from the index store'.format(video_id, len(segments)))
+					return twitchio
+				# Twitch moved the segments, the index would fail on every read until it expires
+				logging.info('Segments of the stored index of video {} are gone, building it again'.format(video_id))
+				index_store.invalidate(video_id)
+				twitchio.close()
+		playlist = twitch_playlist.get_source_playlist(video_id, headers)
+		twitchio = TwitchIO(playlist.segments, **kwargs)
+		if index_store is not None and playlist.is_endlist:
+			index_store.save(video_id, twitchio.segments, twitchio.get_chunk_sizes())
+		return twitchio
+	def split_parts(self, max_size=None, max_duration=None, plan=None):
+		# Yield the parts of a SplitPlan as TwitchIOs, by default the plan from plan_parts
+		if plan is None:
+			plan = self.plan_parts(max_size, max_duration)
+		for part in plan:
+			yield self.part(part.first, part.last)
+	def part(self, first, last):
+		# Return a TwitchIO for the segments [first, last) that shares session, cache and settings with this one
+		# The segment index of the part is a view of this one so nothing is copied
+		return TwitchIO(self.segments[first:last], build_index=False, prefetch=self.prefetch, prefetch_memory=self.prefetch_memory, cache=self.cache, timeout=self.timeout, limiter=self.limiter, session=self.session, download_slots=self.download_slots, range_fraction=self.range_fraction, retry_policy=self.retry_policy)
+	def plan_parts(self, max_size=None, max_duration=None, balanced=True):
+		# Split the video at segment boundaries in as few parts as possible that are each at most
+		# max_size bytes and max_duration seconds long, a single segment that is larger gets its own part.
+		# If balanced the parts are then made as equal as possible instead of leaving a short last part:
+		# the limits are scaled down by the smallest factor that still needs the same number of parts.
+		# Every greedy pass takes O(parts * log(segments)) by bisecting the index.
+		offset_index = self.offset_index
+		time_index = self.time_index
+		def greedy(size_limit, duration_limit):
+			parts = list()
+			first = 0
+			while first < len(self.segments):
+				base_offset = offset_index[first - 1] if first > 0 else 0
+				base_time = time_index[first - 1] if first > 0 else 0.0
+				last = len(self.segments)
+				if size_limit is not None:
+					last = min(last, offset_index.bisect(base_offset + size_limit, first))
+				if duration_limit is not None:
+					last = min(last, time_index.bisect(base_time + duration_limit, first))
+				last = max(last, first + 1)
+				parts.append((first, last))
+				first = last
+			return parts
+		def scaled(factor):
+			return greedy(
+				max_size * factor if max_size is not None else None,
+				max_duration * factor if max_duration is not None else None)
+		boundaries = greedy(max_size, max_duration)
+		if balanced and len(boundaries) > 1:
+			low = 1.0 / (len(boundaries) + 1)
+			high = 1.0
+			for _ in range(50):
+				middle = (low + high) / 2
+				if len(scaled(middle)) <= len(boundaries):
+					high = middle
+				else:
+					low = middle
+			boundaries = scaled(high)
+		if len(boundaries) == 0:
+			boundaries = [(0, 0)]
+		parts = list()
+		for first, last in boundaries:
+			base_offset = offset_index[first - 1] if first > 0 else 0
+			base_time = time_index[first - 1] if first > 0 else 0.0
+			end_offset = offset_index[last - 1] if last > 0 else 0
+			end_time = time_index[last - 1] if last > 0 else 0.0
+			parts.append(PlannedPart(first, last, end_offset - base_offset, end_time - base_time))
+		return SplitPlan(parts)
+	def build_index(self, workers=16):
+		self.set_index(self.find_sizes(self.segments, workers))
+	def find_sizes(self, segments, workers=16):
+		# Return the sizes of segments.
+		# Some older vods dont have start and end offsets in the playlist
+		# so for those we need to send head requests to get the chunk size.
+		# Those are sent concurrently by up to workers threads.
+		uris = [segment.uri for segment in segments]
+		sizes = parse_sizes(uris)
+		missing = [i for i, size in enumerate(sizes) if size is None]
+		if len(missing) > 0:
+			logging.info('Sending {} head requests to build the index'.format(len(missing)))
+			with ThreadPoolExecutor(max_workers=workers) as executor:
+				for i, size in zip(missing, executor.map(self.head_chunk_size, [uris[i] for i in missing])):
+					sizes[i] = size
+		return sizes
+	def set_index(self, sizes):
+		# sizes contains the size in bytes of every segment
+		self.segments = SegmentIndex.from_segments(self.segments, sizes)
+	def append_segments(self, segments, workers=16):
+		# Add segments to the end of the video, for videos that are still recording
+		# and whose playlist grows while they are being read
+		self.segments.append(segments, self.find_sizes(segments, workers))
+	# The index is kept by the SegmentIndex in self.segments, offset_index and time_index
+	# contain the end offset and end time of every segment
+	@property
+	def offset_index(self):
+		return self.segments.offset_index
+	@property
+	def time_index(self):
+		return self.segments.time_index
+	@property
+	def size(self):
+		return self.segments.size
+	@property
+	def duration(self):
+		return self.segments.total_duration
+	def segment_available(self, index):
+		# Return whether segment index can still be downloaded, used to check an index from an IndexStore
+		if index >= len(self.segments):
+			return True
+		uri = self.segments.uri(index)
+		try:
+			self.retry_policy.call(lambda: self.request('head', uri), uri, 'HEAD chunk {}'.format(uri), 'head')
+		except requests.exceptions.HTTPError:
+			return False
+		return True
+	def head_chunk_size(self, uri):
+		response = self.retry_policy.call(lambda: self.request('head', uri), uri, 'HEAD chunk {}'.format(uri), 'head')
+		return int(response.headers['Content-Length'])
 	def seek(self, offset, whence=0):
 		if whence == 0:
 			pos = offset
@@ -112,49 +309,163 @@ class TwitchIO(IOBase):
 		else:
 			raise RuntimeError('Unrecognized whence constant')
 		if pos > self.size: pos = self.size
+		if pos != self.position:
+			self.sequential = False
 		self.index = self.get_index_for_offset(pos) if pos < self.size else None
 		self.position = pos
+		if self.prefetcher is not None:
+			if self.index is None:
+				self.prefetcher.discard(0, -1)
+			else:
+				self.prefetcher.discard(self.index, self.index + self.prefetcher.count)
+		return self.position
 	def get_index_for_offset(self, offset):
 		assert(offset >= 0)
 		assert(offset < self.size)
-		return bisect.bisect(self.offset_index, offset)
+		return self.segments.segment_at(offset)
+	def get_chunk_size(self, index):
+		return self.segments.chunk_size(index)
+	def get_chunk_sizes(self):
+		return [self.get_chunk_size(i) for i in range(len(self.segments))]
 	def read_chunk(self, index):
-		if index == self.last_chunk_index:
-			return self.last_chunk
-		while True:
-			try:
-				response = self.session.get(self.segments[index].uri, timeout=12.1)
-				response.raise_for_status()
-				self.last_chunk_index = index
-				self.last_chunk = response.content
-				return self.last_chunk
-			except (requests.exceptions.RequestException, requests.exceptions.HTTPError) as e:
-				logging.warning('Encounted following exception while trying to download chunk {} {}'.format(index, e))
-				time.sleep(12.1)
-				continue
+		uri = self.segments[index].uri
+		chunk = self.cache.get(uri)
+		if chunk is not None:
+			return chunk
+		future = None
+		if self.prefetcher is not None:
+			future = self.prefetcher.take(index)
+			# start fetching the following chunks before possibly blocking on this one
+			self.prefetcher.advance(index)
+		chunk = future.result() if future is not None else self.download_chunk(index)
+		self.cache.put(uri, chunk)
+		return chunk
+	def request(self, method, uri, headers=None):
+		# Send a single request and record its latency and throughput
+		start = time.monotonic()
+		if method == 'head':
+			response = self.session.head(uri, headers=headers, timeout=self.timeout)
+		else:
+			with self.download_slots or nullcontext():
+				response = self.session.get(uri, headers=headers, timeout=self.timeout)
+		elapsed = time.monotonic() - start
+		metrics.registry.observe('twitch_request_seconds', elapsed, method=method)
+		response.raise_for_status()
+		if method == 'get':
+			metrics.registry.increment('twitch_downloaded_bytes_total', len(response.content))
+			metrics.registry.observe('twitch_segment_bytes_per_second', len(response.content) / max(elapsed, 1e-6))
+			if self.limiter is not None:
+				self.limiter.consume(len(response.content))
+		return response
+	def download_chunk(self, index):
+		# Can be called from the prefetch threads so it must not touch the cache.
+		# A chunk whose size does not match the index is downloaded again, it would not fit at its offset.
+		uri = self.segments[index].uri
+		def download():
+			return check_length(self.request('get', uri).content, self.get_chunk_size(index))
+		return self.retry_policy.call(download, uri, 'download chunk {}'.format(index), 'get')
+	def plan_fetch(self, index, start, length):
+		# Decide how much of chunk index to download for a read of length bytes at start within the chunk.
+		# Returns the byte range (start, end) to download or None to download the whole chunk.
+		# Whole chunks are always used when they are cached or being prefetched. Otherwise a range is used
+		# for small reads right after a seek, such as probing container headers,
+		# and for reads that begin far enough into the chunk, such as a resumed upload.
+		# Reads from the start of a chunk always get the whole chunk, uploads seek back to 0
+		# before reading everything and would otherwise download the start of the video twice.
+		if self.range_fraction is None or start == 0:
+			return None
+		if self.segments[index].uri in self.cache or (self.prefetcher is not None and index in self.prefetcher.pending):
+			return None
+		size = self.get_chunk_size(index)
+		if not self.sequential and length <= size * self.range_fraction:
+			return (start, start + length)
+		if start >= size * self.range_fraction:
+			return (start, size)
+		return None
+	def read_chunk_range(self, index, start, length):
+		# Return (data, data_start) where data contains at least the bytes [start, start + length) of chunk index
+		# and data_start is the position of data within the chunk
+		if self.current is not None and self.current[0] == index:
+			return self.current[1], 0
+		if self.partial is not None:
+			partial_index, partial_start, partial = self.partial
+			if partial_index == index and partial_start <= start and start + length <= partial_start + len(partial):
+				return partial, partial_start
+		byte_range = self.plan_fetch(index, start, length)
+		if byte_range is None:
+			self.current = (index, self.read_chunk(index))
+			return self.current[1], 0
+		data, data_start = self.download_range(index, *byte_range)
+		if data_start == 0 and len(data) == self.get_chunk_size(index):
+			# The server sent the whole chunk anyway
+			self.cache.put(self.segments[index].uri, data)
+			self.current = (index, data)
+		else:
+			self.partial = (index, data_start, data)
+		return data, data_start
+	def download_range(self, index, start, end):
+		# Download the bytes [start, end) of chunk index and return (data, data_start).
+		# Segments with offsets in their uri are requested with changed offsets, others with a Range header.
+		# If the server ignores the Range header the whole chunk is returned with data_start 0.
+		uri = self.segments[index].uri
+		offsets = parse_offsets(uri)
+		headers = dict()
+		if offsets is not None:
+			uri = replace_offsets(uri, offsets[0] + start, offsets[0] + end - 1)
+		else:
+			headers['Range'] = 'bytes={}-{}'.format(start, end - 1)
+		def download():
+			response = self.request('get', uri, headers)
+			if offsets is None and response.status_code != 206:
+				return response.content, 0
+			return check_length(response.content, end - start), start
+		return self.retry_policy.call(download, uri, 'download range {}-{} of chunk {}'.format(start, end, index), 'range')
 	def read(self, size=-1):
 		#print('\rread', self.position, self.size, size, '              ', end='')
 		assert(size == -1 or size >= 0)
 		end_position = self.size if size == -1 else min(self.position + size, self.size)
-
-		result = bytearray()
-
-		while self.position < end_position:
-			self.index = self.get_index_for_offset(self.position)
-
-			chunk_start = self.offset_index[self.index - 1] if self.index > 0 else 0
-			chunk_end = self.offset_index[self.index]
-			chunk_size = chunk_end - chunk_start
-			bytes_left_in_chunk = chunk_end - self.position
-			assert(bytes_left_in_chunk > 0)
-			chunk = self.read_chunk(self.index)
-			chunk_pos = self.position - chunk_start
-
-			number_of_bytes_to_read = min(end_position - self.position, chunk_size - chunk_pos)
-			result += chunk[chunk_pos:chunk_pos + number_of_bytes_to_read]
-			self.position += number_of_bytes_to_read
-
+		result = bytearray(max(end_position - self.position, 0))
+		self.readinto(result)
 		return result
+	def plan_read(self, length):
+		# Yield (index, start within the chunk, number of bytes) for every chunk that a read
+		# of length bytes at the current position touches, shared with AsyncTwitchIO.
+		# The chunk bounds are read straight from the offsets of the SegmentIndex and the index is only
+		# bisected when the position is not in the chunk of the last read or the one after it.
+		offsets = self.segments.data.offsets
+		first = self.segments.first
+		base = offsets[first]
+		count = len(self.segments)
+		position = self.position
+		end_position = min(position + length, self.size)
+		index = self.index
+		while position < end_position:
+			# the comparisons are inlined because this runs for every small read
+			absolute = base + position
+			if index is None or index >= count or not offsets[first + index] <= absolute < offsets[first + index + 1]:
+				if index is not None and index + 1 < count and offsets[first + index + 1] <= absolute < offsets[first + index + 2]:
+					index += 1
+				else:
+					index = self.get_index_for_offset(position)
+			chunk_start = offsets[first + index] - base
+			number_of_bytes_to_read = min(end_position, offsets[first + index + 1] - base) - position
+			yield index, position - chunk_start, number_of_bytes_to_read
+			position += number_of_bytes_to_read
+			index += 1
+	def readinto(self, buffer):
+		# Copies straight from the cached chunks into buffer through memoryviews
+		# so every byte is copied exactly once even when the read spans several chunks.
+		view = memoryview(buffer).cast('B')
+		written = 0
+		for index, chunk_pos, number_of_bytes_to_read in self.plan_read(len(view)):
+			self.index = index
+			data, data_start = self.read_chunk_range(index, chunk_pos, number_of_bytes_to_read)
+			data_pos = chunk_pos - data_start
+			view[written:written + number_of_bytes_to_read] = memoryview(data)[data_pos:data_pos + number_of_bytes_to_read]
+			written += number_of_bytes_to_read
+			self.position += number_of_bytes_to_read
+		self.sequential = True
+		return written
 	def seekable(self):
 		return True
 	def readable(self):
@@ -163,3 +474,8 @@ class TwitchIO(IOBase):
 		return self.position
 	def writeable(self):
 		return False
+	def close(self):
+		# the constructor might not have gotten as far as creating the prefetcher
+		if getattr(self, 'prefetcher', None) is not None:
+			self.prefetcher.close()
+		super().close()
@@ -0,0 +1,69 @@
+# Micro benchmark of the TwitchIO read path without any network access.
+# Compares the old read implementation, which appended slices of the chunk to a bytearray,
+# with the current read and readinto.
+# Run from the repository root: python benchmarks/read_path.py
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from TwitchIO import TwitchIO
+from index_store import Segment
+from segment_cache import SegmentCache
+
+
+# TwitchIO whose chunks are generated in memory instead of downloaded
+class MemoryTwitchIO(TwitchIO):
+	def __init__(self, segment_count, segment_size):
+		segments = [Segment('memory://{}'.format(i), 2.0) for i in range(segment_count)]
+		super().__init__(segments, build_index=False, cache=SegmentCache(segment_count * segment_size))
+		self.set_index([segment_size] * segment_count)
+		self.chunk = os.urandom(segment_size)
+	def download_chunk(self, index):
+		return self.chunk
+
+def legacy_read(self, size=-1):
+	# The read implementation before readinto was added
+	end_position = self.size if size == -1 else min(self.position + size, self.size)
+	result = bytearray()
+	while self.position < end_position:
+		self.index = self.get_index_for_offset(self.position)
+		chunk_start = self.offset_index[self.index - 1] if self.index > 0 else 0
+		chunk_end = self.offset_index[self.index]
+		chunk_size = chunk_end - chunk_start
+		chunk = self.read_chunk(self.index)
+		chunk_pos = self.position - chunk_start
+		number_of_bytes_to_read = min(end_position - self.position, chunk_size - chunk_pos)
+		result += chunk[chunk_pos:chunk_pos + number_of_bytes_to_read]
+		self.position += number_of_bytes_to_read
+	return result
+
+def measure(twitchio, read_size, rounds, read):
+	start = time.perf_counter()
+	for _ in range(rounds):
+		twitchio.seek(0)
+		while read(read_size):
+			pass
+	elapsed = time.perf_counter() - start
+	return twitchio.size * rounds / elapsed / 2**20
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser( description='Benchmark the TwitchIO read path.' )
+	parser.add_argument( '--segments', type=int, default=32 )
+	parser.add_argument( '--segment-size', type=int, default=4*(2**20) )
+	parser.add_argument( '--rounds', type=int, default=5 )
+	args = parser.parse_args()
+
+	twitchio = MemoryTwitchIO(args.segments, args.segment_size)
+	twitchio.read() # fill the cache so only the read path is measured
+	for read_size in [2**13, 2**16, 2**20, 10*(2**20), 100*(2**20)]:
+		buffer = bytearray(read_size)
+		readinto = lambda size: twitchio.readinto(buffer)
+		print('read size {:>10}: legacy read {:8.1f} MB/s, read {:8.1f} MB/s, readinto {:8.1f} MB/s'.format(
+			read_size,
+			measure(twitchio, read_size, args.rounds, lambda size: legacy_read(twitchio, size)),
+			measure(twitchio, read_size, args.rounds, twitchio.read),
+			measure(twitchio, read_size, args.rounds, readinto)))
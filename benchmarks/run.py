@@ -0,0 +1,154 @@
+# Offline benchmarks of TwitchIO, download_video and the Youtube upload against the local stand-in server.
+# Reports index time, read throughput, seek cost and end to end transfer rates.
+# Run from the repository root: python benchmarks/run.py
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from apiclient.http import HttpRequest, build_http
+
+from standin import StandinServer
+from TwitchIO import TwitchIO
+from youtube import YoutubeUploader
+import twitch_downloader
+import twitch_playlist
+import http_pool
+
+
+def timed(function):
+	start = time.perf_counter()
+	result = function()
+	return result, time.perf_counter() - start
+
+def megabytes_per_second(size, seconds):
+	return size / seconds / 2**20
+
+def benchmark_index(standin, args):
+	twitchio, seconds = timed(lambda: TwitchIO.from_twitch('1', index_workers=args.index_workers))
+	return {'index seconds': seconds}
+
+def benchmark_read(standin, args):
+	twitchio = TwitchIO.from_twitch('1', prefetch=args.prefetch)
+	buffer = bytearray(args.read_size)
+	def read_all():
+		while twitchio.readinto(buffer) > 0:
+			pass
+	_, seconds = timed(read_all)
+	twitchio.close()
+	return {'read MB/s': megabytes_per_second(twitchio.size, seconds)}
+
+def benchmark_seek(standin, args):
+	twitchio = TwitchIO.from_twitch('1')
+	rng = random.Random(1)
+	served_before = standin.requests.get('segment bytes', 0)
+	def seek_and_read():
+		for _ in range(args.seeks):
+			twitchio.seek(rng.randrange(twitchio.size))
+			twitchio.read(args.seek_read_size)
+	_, seconds = timed(seek_and_read)
+	return {
+		'seek+read ms': seconds / args.seeks * 1000,
+		'bytes downloaded per seek': (standin.requests.get('segment bytes', 0) - served_before) / args.seeks }
+
+def benchmark_download(standin, args):
+	with tempfile.TemporaryDirectory() as directory:
+		filename = os.path.join(directory, 'video.ts')
+		_, seconds = timed(lambda: twitch_downloader.download_video('1', filename, workers=args.download_workers))
+		size = os.path.getsize(filename)
+	return {'download MB/s': megabytes_per_second(size, seconds)}
+
+def benchmark_upload(standin, args):
+	twitchio = TwitchIO.from_twitch('1', prefetch=args.prefetch)
+	media_body = YoutubeUploader.iobase_to_media_body(twitchio, args.upload_chunk_size, args.adaptive_chunk_size)
+	request = HttpRequest(build_http(), lambda response, content: json.loads(content), standin.url + '/upload', method='POST', body='{}', headers=dict(), resumable=media_body)
+	def upload():
+		response = None
+		while response is None:
+			try:
+				status, response = request.next_chunk()
+			except Exception:
+				# errors injected by the stand-in, the request resumes on the next call
+				continue
+	_, seconds = timed(upload)
+	if hasattr(media_body, 'close'):
+		media_body.close()
+	return {'upload MB/s': megabytes_per_second(twitchio.size, seconds)}
+
+def benchmark_async_read(standin, args):
+	# args.transfers concurrent reads of the whole video on one event loop
+	try:
+		from AsyncTwitchIO import AsyncTwitchIO, EventLoopThread, SyncTwitchIO
+	except ImportError:
+		print('async-read needs the aiohttp package, skipped')
+		return dict()
+	loop_thread = EventLoopThread()
+	async def transfer():
+		twitchio = await AsyncTwitchIO.from_twitch('1', loop_thread.session, prefetch=args.prefetch)
+		buffer = bytearray(args.read_size)
+		while await twitchio.readinto(buffer) > 0:
+			pass
+		twitchio.close()
+		return twitchio.size
+	async def transfers():
+		return sum(await asyncio.gather(*[transfer() for _ in range(args.transfers)]))
+	size, seconds = timed(lambda: loop_thread.run(transfers()))
+	sync_twitchio = SyncTwitchIO.from_twitch('1', loop_thread, prefetch=args.prefetch)
+	buffer = bytearray(args.read_size)
+	def read_all():
+		while sync_twitchio.readinto(buffer) > 0:
+			pass
+	_, sync_seconds = timed(read_all)
+	sync_twitchio.close()
+	loop_thread.close()
+	return {
+		'async read MB/s': megabytes_per_second(size, seconds),
+		'sync adapter read MB/s': megabytes_per_second(sync_twitchio.size, sync_seconds) }
+
+benchmarks = {
+	'index': benchmark_index,
+	'read': benchmark_read,
+	'seek': benchmark_seek,
+	'download': benchmark_download,
+	'upload': benchmark_upload,
+	'async-read': benchmark_async_read }
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser( description='Benchmark the transfer pipeline against a local stand-in server.' )
+	parser.add_argument( '--benchmarks', help='Comma separated benchmarks to run.', default=','.join(benchmarks) )
+	parser.add_argument( '--segments', type=int, default=64 )
+	parser.add_argument( '--segment-size', type=int, default=2**20 )
+	parser.add_argument( '--no-offsets', help='Serve segments without start_offset and end_offset.', action='store_true' )
+	parser.add_argument( '--latency', help='Seconds added to every response.', type=float, default=0.01 )
+	parser.add_argument( '--bandwidth', help='Bytes per second of every response.', type=int, required=False )
+	parser.add_argument( '--error-rate', help='Probability of a request failing with 503.', type=float, default=0.0 )
+	parser.add_argument( '--index-workers', type=int, default=16 )
+	parser.add_argument( '--prefetch', type=int, default=4 )
+	parser.add_argument( '--read-size', type=int, default=2**20 )
+	parser.add_argument( '--seeks', type=int, default=50 )
+	parser.add_argument( '--seek-read-size', type=int, default=4096 )
+	parser.add_argument( '--transfers', help='Number of concurrent transfers of the async-read benchmark.', type=int, default=8 )
+	parser.add_argument( '--download-workers', type=int, default=4 )
+	parser.add_argument( '--upload-chunk-size', type=int, default=-1 )
+	parser.add_argument( '--adaptive-chunk-size', action='store_true' )
+	args = parser.parse_args()
+
+	standin = StandinServer(args.segments, args.segment_size, offsets=not args.no_offsets,
+		latency=args.latency, bandwidth=args.bandwidth, error_rate=args.error_rate).start()
+	twitch_playlist.twitch_api_url = standin.url
+	twitch_playlist.twitch_usher_url = standin.url
+	try:
+		for name in args.benchmarks.split(','):
+			for key, value in benchmarks[name](standin, args).items():
+				print('{:>28}: {:10.2f}'.format(key, value))
+	finally:
+		standin.stop()
+	print('Stand-in requests: {}'.format(standin.requests))
+	print('HTTP connections: {}'.format(http_pool.stats()))
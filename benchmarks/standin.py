@@ -0,0 +1,159 @@
+# Local HTTP stand-in for the Twitch and Youtube endpoints used by the benchmarks.
+# Serves the access token, a variant playlist, a source playlist and the segments of synthetic videos
+# as well as a resumable upload endpoint, with configurable latency, bandwidth and error injection.
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import json
+import random
+import re
+import threading
+import time
+import zlib
+
+
+# Every video id serves the same synthetic video of segment_count segments of segment_size bytes.
+# If offsets is True segments are byte ranges of one file addressed with start_offset and end_offset
+# like newer Twitch videos, otherwise every segment has its own uri and its size must be found with HEAD.
+# latency is added to every response in seconds, bandwidth limits every response body in bytes per second
+# and error_rate is the probability of answering a segment request or an upload chunk with a 503.
+class StandinServer:
+	def __init__(self, segment_count=64, segment_size=2**20, segment_duration=10.0, offsets=True, latency=0.0, bandwidth=None, error_rate=0.0, seed=0):
+		self.segment_count = segment_count
+		self.segment_size = segment_size
+		self.segment_duration = segment_duration
+		self.offsets = offsets
+		self.latency = latency
+		self.bandwidth = bandwidth
+		self.error_rate = error_rate
+		self.random = random.Random(seed)
+		self.data = self.random.randbytes(segment_count * segment_size)
+		self.lock = threading.Lock()
+		self.requests = dict()
+		# upload session id -> [received bytes, crc32 of received bytes]
+		self.uploads = dict()
+		self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler_class())
+		self.server.daemon_threads = True
+		self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+		self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+	def start(self):
+		self.thread.start()
+		return self
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+	def count(self, kind, amount=1):
+		with self.lock:
+			self.requests[kind] = self.requests.get(kind, 0) + amount
+	def fail(self):
+		with self.lock:
+			return self.random.random() < self.error_rate
+	def variant_playlist(self, video_id):
+		return '\n'.join([
+			'#EXTM3U',
+			'#EXT-X-MEDIA:TYPE=VIDEO,GROUP-ID="chunked",NAME="Source",AUTOSELECT=YES,DEFAULT=YES',
+			'#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=None,CODECS="avc1.4D401F,mp4a.40.2",VIDEO="chunked"',
+			'{}/source/{}/index-dvr.m3u8'.format(self.url, video_id),
+			''])
+	def source_playlist(self):
+		lines = ['#EXTM3U', '#EXT-X-TARGETDURATION:{}'.format(int(self.segment_duration) + 1)]
+		for i in range(self.segment_count):
+			lines.append('#EXTINF:{},'.format(self.segment_duration))
+			if self.offsets:
+				lines.append('video.ts?start_offset={}&end_offset={}'.format(i * self.segment_size, (i + 1) * self.segment_size - 1))
+			else:
+				lines.append('{}.ts'.format(i))
+		lines.append('#EXT-X-ENDLIST')
+		return '\n'.join(lines) + '\n'
+	def handler_class(self):
+		standin = self
+		class Handler(BaseHTTPRequestHandler):
+			protocol_version = 'HTTP/1.1'
+			disable_nagle_algorithm = True
+			def log_message(self, format, *args):
+				pass
+			def send(self, status, body=b'', headers=dict(), head=False):
+				self.send_response(status)
+				for key, value in headers.items():
+					self.send_header(key, value)
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				if head:
+					return
+				view = memoryview(body)
+				block = 64 * 1024
+				for position in range(0, len(view), block):
+					self.wfile.write(view[position:position + block])
+					if standin.bandwidth is not None:
+						time.sleep(min(block, len(view) - position) / standin.bandwidth)
+			def segment(self, path, query):
+				# Return the bytes of the segment at path or None
+				match = re.match(r'^/source/[^/]+/(\d+)\.ts$', path)
+				if match is not None:
+					index = int(match.group(1))
+					if index >= standin.segment_count:
+						return None
+					return standin.data[index * standin.segment_size:(index + 1) * standin.segment_size]
+				if re.match(r'^/source/[^/]+/video\.ts$', path) and 'start_offset' in query and 'end_offset' in query:
+					return standin.data[int(query['start_offset'][0]):int(query['end_offset'][0]) + 1]
+				return None
+			def do_HEAD(self):
+				self.do_GET(head=True)
+			def do_GET(self, head=False):
+				time.sleep(standin.latency)
+				url = urlparse(self.path)
+				query = parse_qs(url.query)
+				standin.count('HEAD' if head else 'GET')
+				if re.match(r'^/api/vods/[^/]+/access_token$', url.path):
+					return self.send(200, json.dumps(dict(token='token', sig='sig')).encode(), head=head)
+				match = re.match(r'^/vod/([^/]+)$', url.path)
+				if match is not None:
+					return self.send(200, standin.variant_playlist(match.group(1)).encode(), head=head)
+				if re.match(r'^/source/[^/]+/index-dvr\.m3u8$', url.path):
+					return self.send(200, standin.source_playlist().encode(), head=head)
+				data = self.segment(url.path, query)
+				if data is None:
+					return self.send(404, head=head)
+				if standin.fail():
+					standin.count('errors')
+					return self.send(503, b'injected error', head=head)
+				match = re.match(r'^bytes=(\d+)-(\d+)$', self.headers.get('Range', ''))
+				if match is not None:
+					start, end = int(match.group(1)), int(match.group(2))
+					if not head:
+						standin.count('segment bytes', end + 1 - start)
+					return self.send(206, data[start:end + 1], {'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(data))}, head=head)
+				if not head:
+					standin.count('segment bytes', len(data))
+				return self.send(200, data, head=head)
+			def do_POST(self):
+				# Start of a resumable upload, the metadata in the body is ignored
+				time.sleep(standin.latency)
+				self.rfile.read(int(self.headers.get('Content-Length', 0)))
+				standin.count('POST')
+				with standin.lock:
+					session = len(standin.uploads)
+					standin.uploads[session] = [0, 0]
+				self.send(200, headers={'Location': '{}/upload/session/{}'.format(standin.url, session)})
+			def do_PUT(self):
+				time.sleep(standin.latency)
+				body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+				standin.count('PUT')
+				match = re.match(r'^/upload/session/(\d+)$', self.path)
+				if match is None or int(match.group(1)) not in standin.uploads:
+					return self.send(404)
+				upload = standin.uploads[int(match.group(1))]
+				if standin.fail():
+					standin.count('errors')
+					return self.send(503, b'injected error')
+				content_range = self.headers.get('Content-Range', '')
+				match = re.match(r'^bytes (\d+)-(\d+)/(\d+|\*)$', content_range)
+				if match is not None and int(match.group(1)) == upload[0]:
+					upload[0] += len(body)
+					upload[1] = zlib.crc32(body, upload[1])
+				total = content_range.rsplit('/', 1)[-1]
+				if total != '*' and upload[0] == int(total):
+					return self.send(200, json.dumps(dict(id='standin{}'.format(len(standin.uploads)))).encode())
+				headers = {'Range': 'bytes=0-{}'.format(upload[0] - 1)} if upload[0] > 0 else dict()
+				self.send(308, headers=headers)
+		return Handler
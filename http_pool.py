@@ -0,0 +1,115 @@
+# Shared HTTP connection pool for all Twitch api, usher and CDN requests
+
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+import metrics
+
+
+lock = threading.Lock()
+session = None
+# Number of requests sent and number of connections opened, the difference are reused connections
+counts = {'requests': 0, 'connections': 0}
+
+def count(key):
+	with lock:
+		counts[key] += 1
+	metrics.registry.increment('http_{}_total'.format(key))
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+	def _new_conn(self):
+		count('connections')
+		return super()._new_conn()
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+	def _new_conn(self):
+		count('connections')
+		return super()._new_conn()
+
+# Transport adapter that counts requests and the connections opened for them
+class PoolAdapter(HTTPAdapter):
+	def init_poolmanager(self, *args, **kwargs):
+		super().init_poolmanager(*args, **kwargs)
+		self.poolmanager.pool_classes_by_scheme = {'http': CountingHTTPConnectionPool, 'https': CountingHTTPSConnectionPool}
+	def send(self, request, **kwargs):
+		count('requests')
+		return super().send(request, **kwargs)
+
+# Response of an Http2Session that behaves like a requests.Response for the parts this program uses
+class Http2Response:
+	def __init__(self, response):
+		self.response = response
+	def __getattr__(self, name):
+		return getattr(self.response, name)
+	@property
+	def encoding(self):
+		return self.response.encoding
+	@encoding.setter
+	def encoding(self, value):
+		self.response.encoding = value
+	def raise_for_status(self):
+		if self.response.status_code >= 400:
+			raise requests.exceptions.HTTPError('{} error for url {}'.format(self.response.status_code, self.response.url), response=self)
+
+# Session on top of httpx that speaks HTTP/2 where the server supports it.
+# Only get and head are implemented and httpx errors are turned into the matching requests exceptions
+# so the rest of the program does not need to know which session it uses.
+class Http2Session:
+	def __init__(self, pool_hosts, pool_size, keep_alive):
+		import httpx
+		self.httpx = httpx
+		self.headers = dict()
+		if not keep_alive:
+			self.headers['Connection'] = 'close'
+		limits = httpx.Limits(max_connections=pool_hosts * pool_size, max_keepalive_connections=pool_hosts * pool_size if keep_alive else 0)
+		self.client = httpx.Client(http2=True, limits=limits, follow_redirects=True)
+	def request(self, method, url, params=None, headers=None, timeout=None, **kwargs):
+		count('requests')
+		try:
+			response = self.client.request(method, url, params=params, headers=dict(self.headers, **(headers or dict())), timeout=timeout)
+		except self.httpx.TimeoutException as e:
+			raise requests.exceptions.Timeout(e)
+		except self.httpx.HTTPError as e:
+			raise requests.exceptions.ConnectionError(e)
+		return Http2Response(response)
+	def get(self, url, **kwargs):
+		return self.request('GET', url, **kwargs)
+	def head(self, url, **kwargs):
+		return self.request('HEAD', url, **kwargs)
+
+def configure(pool_hosts=16, pool_size=32, block=False, keep_alive=True, http2=False):
+	# Create the shared session.
+	# pool_hosts is the number of hosts connections are kept open for, pool_size the number of
+	# connections per host. If block is True pool_size is a hard limit and requests wait for a free connection.
+	# http2 needs the optional httpx package with http2 support, without it HTTP/1.1 is used.
+	global session
+	if http2:
+		try:
+			new_session = Http2Session(pool_hosts, pool_size, keep_alive)
+		except ImportError:
+			logging.warning('HTTP/2 needs the httpx package with http2 support, using HTTP/1.1')
+			http2 = False
+	if not http2:
+		new_session = requests.Session()
+		adapter = PoolAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size, pool_block=block)
+		new_session.mount('http://', adapter)
+		new_session.mount('https://', adapter)
+		if not keep_alive:
+			new_session.headers['Connection'] = 'close'
+	with lock:
+		session = new_session
+	return new_session
+
+def shared_session():
+	# Return the shared session, created with the default settings if configure was not called
+	with lock:
+		if session is not None:
+			return session
+	return configure()
+
+def stats():
+	with lock:
+		return dict(counts, reused=counts['requests'] - counts['connections'])
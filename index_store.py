@@ -0,0 +1,66 @@
+# Persistent store for the segment index of Twitch videos
+
+from array import array
+import collections
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+
+
+# Stand-in for the m3u8 segment objects, TwitchIO only needs the uri and the duration of a segment
+Segment = collections.namedtuple('Segment', ['uri', 'duration'])
+
+# Saves the segment uris, sizes and durations of a video in an sqlite file keyed by the video id
+# so that a TwitchIO for a video that was already indexed can be created without any requests.
+# An entry is used only if it was written with the current FORMAT_VERSION and is younger than max_age seconds,
+# older entries are deleted on load because Twitch can move the segments of a video.
+# Entries can also be removed explicitly with invalidate.
+class IndexStore:
+	FORMAT_VERSION = 1
+	def __init__(self, filename, max_age=7*24*60*60):
+		self.max_age = max_age
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(filename, check_same_thread=False)
+		with self.lock, self.connection:
+			self.connection.execute(
+				'CREATE TABLE IF NOT EXISTS segment_index ('
+				'video_id TEXT PRIMARY KEY, version INTEGER, created REAL, data BLOB)')
+	def save(self, video_id, segments, sizes):
+		uris = '\n'.join(segment.uri for segment in segments).encode()
+		durations = array('d', (segment.duration for segment in segments)).tobytes()
+		sizes = array('q', sizes).tobytes()
+		header = array('q', [len(segments), len(uris)]).tobytes()
+		data = zlib.compress(header + sizes + durations + uris)
+		with self.lock, self.connection:
+			self.connection.execute(
+				'INSERT OR REPLACE INTO segment_index VALUES (?, ?, ?, ?)',
+				(video_id, self.FORMAT_VERSION, time.time(), data))
+	def load(self, video_id):
+		# Return (segments, sizes) or None if there is no valid entry for video_id
+		with self.lock:
+			row = self.connection.execute(
+				'SELECT version, created, data FROM segment_index WHERE video_id = ?', (video_id,)).fetchone()
+		if row is None:
+			return None
+		version, created, data = row
+		if version != self.FORMAT_VERSION or time.time() - created > self.max_age:
+			logging.info('Discarding stale index of video {}'.format(video_id))
+			self.invalidate(video_id)
+			return None
+		data = zlib.decompress(data)
+		count, uris_length = array('q', data[:16])
+		position = 16
+		sizes = array('q', data[position:position + 8 * count])
+		position += 8 * count
+		durations = array('d', data[position:position + 8 * count])
+		position += 8 * count
+		uris = data[position:position + uris_length].decode().split('\n')
+		segments = [Segment(uri, duration) for uri, duration in zip(uris, durations)]
+		return (segments, list(sizes))
+	def invalidate(self, video_id):
+		with self.lock, self.connection:
+			self.connection.execute('DELETE FROM segment_index WHERE video_id = ?', (video_id,))
+	def close(self):
+		self.connection.close()
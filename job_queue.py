@@ -0,0 +1,146 @@
+# Persistent queue of videos to upload for the daemon mode
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from TwitchIO import PlannedPart, SplitPlan
+
+
+# Keeps the videos found on the mirrored channels and the parts they are uploaded as in an sqlite file,
+# so a restarted daemon continues where it stopped instead of starting over.
+# Videos and parts are pending, running, done or failed. Every video is only queued once,
+# jobs that were running when the process stopped are pending again on the next start
+# and a failed video is retried until it failed max_attempts times. Videos that are released on a clean stop
+# do not lose their attempt, a video that was still running when the process died counts as failed
+# once it used up its attempts, so one that crashes the process is not claimed forever.
+# For every part the Youtube id is recorded as soon as it is uploaded and whether it was added to the playlist,
+# the plan of the first attempt is kept so those parts stay valid.
+class JobQueue:
+	PENDING = 'pending'
+	RUNNING = 'running'
+	DONE = 'done'
+	FAILED = 'failed'
+	def __init__(self, filename, max_attempts=3):
+		self.max_attempts = max_attempts
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(filename, check_same_thread=False)
+		with self.lock, self.connection:
+			self.connection.execute(
+				'CREATE TABLE IF NOT EXISTS videos ('
+				'video_id TEXT PRIMARY KEY, channel TEXT, recorded_at TEXT, video TEXT, state TEXT, '
+				'attempts INTEGER, playlist_id TEXT, error TEXT, updated REAL)')
+			self.connection.execute(
+				'CREATE TABLE IF NOT EXISTS parts ('
+				'video_id TEXT, part INTEGER, first INTEGER, last INTEGER, size INTEGER, duration REAL, '
+				'state TEXT, youtube_id TEXT, in_playlist INTEGER, updated REAL, PRIMARY KEY (video_id, part))')
+			# newest video of a channel whose older videos are all queued
+			self.connection.execute(
+				'CREATE TABLE IF NOT EXISTS channels (channel TEXT PRIMARY KEY, newest_video_id TEXT)')
+			self.connection.execute(
+				'UPDATE videos SET state = ?, error = ? WHERE state = ? AND attempts >= ?',
+				(self.FAILED, 'interrupted while running', self.RUNNING, max_attempts))
+			self.connection.execute('UPDATE videos SET state = ? WHERE state = ?', (self.PENDING, self.RUNNING))
+			self.connection.execute('UPDATE parts SET state = ? WHERE state = ?', (self.PENDING, self.RUNNING))
+	def add_video(self, channel, video):
+		# Queue video, return False if it was queued before
+		with self.lock, self.connection:
+			cursor = self.connection.execute(
+				'INSERT OR IGNORE INTO videos VALUES (?, ?, ?, ?, ?, 0, NULL, NULL, ?)',
+				(video['id'], channel, video['recorded_at'], json.dumps(video), self.PENDING, time.time()))
+			return cursor.rowcount > 0
+	def newest_video_id(self, channel):
+		with self.lock:
+			row = self.connection.execute('SELECT newest_video_id FROM channels WHERE channel = ?', (channel,)).fetchone()
+		return row[0] if row is not None else None
+	def set_newest_video_id(self, channel, video_id):
+		with self.lock, self.connection:
+			self.connection.execute('INSERT OR REPLACE INTO channels VALUES (?, ?)', (channel, video_id))
+	def claim(self):
+		# Mark the oldest pending video as running and return it, None if there is none
+		with self.lock, self.connection:
+			row = self.connection.execute(
+				'SELECT video_id, video FROM videos WHERE state = ? ORDER BY recorded_at LIMIT 1', (self.PENDING,)).fetchone()
+			if row is None:
+				return None
+			self.connection.execute(
+				'UPDATE videos SET state = ?, attempts = attempts + 1, updated = ? WHERE video_id = ?',
+				(self.RUNNING, time.time(), row[0]))
+		return json.loads(row[1])
+	def finish(self, video_id):
+		self.set_video_state(video_id, self.DONE)
+	def fail(self, video_id, error):
+		# Put the video back in the queue or give up on it after max_attempts
+		with self.lock, self.connection:
+			attempts, = self.connection.execute('SELECT attempts FROM videos WHERE video_id = ?', (video_id,)).fetchone()
+			state = self.FAILED if attempts >= self.max_attempts else self.PENDING
+			self.connection.execute(
+				'UPDATE videos SET state = ?, error = ?, updated = ? WHERE video_id = ?', (state, error, time.time(), video_id))
+			self.connection.execute(
+				'UPDATE parts SET state = ? WHERE video_id = ? AND state = ?', (self.PENDING, video_id, self.RUNNING))
+		if state == self.FAILED:
+			logging.error('Giving up on video {} after {} attempts {}'.format(video_id, attempts, error))
+		return state
+	def release(self, video_id):
+		# Put a running video back in the queue without counting the attempt, for a clean stop
+		with self.lock, self.connection:
+			self.connection.execute(
+				'UPDATE videos SET state = ?, attempts = MAX(attempts - 1, 0), updated = ? WHERE video_id = ? AND state = ?',
+				(self.PENDING, time.time(), video_id, self.RUNNING))
+			self.connection.execute(
+				'UPDATE parts SET state = ? WHERE video_id = ? AND state = ?', (self.PENDING, video_id, self.RUNNING))
+	def retry_failed(self):
+		# Queue all failed videos again
+		with self.lock, self.connection:
+			self.connection.execute(
+				'UPDATE videos SET state = ?, attempts = 0 WHERE state = ?', (self.PENDING, self.FAILED))
+	def set_video_state(self, video_id, state):
+		with self.lock, self.connection:
+			self.connection.execute(
+				'UPDATE videos SET state = ?, updated = ? WHERE video_id = ?', (state, time.time(), video_id))
+	def plan(self, video_id, plan):
+		# Save plan as the parts of the video if it has none yet and return the saved plan
+		with self.lock, self.connection:
+			rows = self.connection.execute(
+				'SELECT first, last, size, duration FROM parts WHERE video_id = ? ORDER BY part', (video_id,)).fetchall()
+			if len(rows) == 0:
+				rows = [(part.first, part.last, part.size, part.duration) for part in plan]
+				self.connection.executemany(
+					'INSERT INTO parts VALUES (?, ?, ?, ?, ?, ?, ?, NULL, 0, ?)',
+					[(video_id, i) + row + (self.PENDING, time.time()) for i, row in enumerate(rows)])
+		return SplitPlan([PlannedPart(*row) for row in rows])
+	def playlist_id(self, video_id):
+		with self.lock:
+			return self.connection.execute('SELECT playlist_id FROM videos WHERE video_id = ?', (video_id,)).fetchone()[0]
+	def set_playlist_id(self, video_id, playlist_id):
+		with self.lock, self.connection:
+			self.connection.execute('UPDATE videos SET playlist_id = ? WHERE video_id = ?', (playlist_id, video_id))
+	def part(self, video_id, part):
+		# Return (state, youtube_id, in_playlist) of a part
+		with self.lock:
+			state, youtube_id, in_playlist = self.connection.execute(
+				'SELECT state, youtube_id, in_playlist FROM parts WHERE video_id = ? AND part = ?', (video_id, part)).fetchone()
+		return state, youtube_id, bool(in_playlist)
+	def start_part(self, video_id, part):
+		self.update_part(video_id, part, 'state = ?', (self.RUNNING,))
+	def finish_part(self, video_id, part, youtube_id):
+		self.update_part(video_id, part, 'state = ?, youtube_id = ?', (self.DONE, youtube_id))
+	def fail_part(self, video_id, part):
+		self.update_part(video_id, part, 'state = ?', (self.FAILED,))
+	def set_part_in_playlist(self, video_id, part):
+		self.update_part(video_id, part, 'in_playlist = 1', ())
+	def update_part(self, video_id, part, assignments, values):
+		with self.lock, self.connection:
+			self.connection.execute(
+				'UPDATE parts SET {}, updated = ? WHERE video_id = ? AND part = ?'.format(assignments),
+				values + (time.time(), video_id, part))
+	def stats(self):
+		# Number of videos and parts in every state
+		with self.lock:
+			videos = dict(self.connection.execute('SELECT state, COUNT(*) FROM videos GROUP BY state').fetchall())
+			parts = dict(self.connection.execute('SELECT state, COUNT(*) FROM parts GROUP BY state').fetchall())
+		return {'videos': videos, 'parts': parts}
+	def close(self):
+		self.connection.close()
@@ -0,0 +1,85 @@
+# Counters and timings of the whole pipeline, exportable for monitoring
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+
+# Thread safe collection of metrics.
+# Counters only go up, observations keep their count, sum and maximum like a Prometheus summary.
+# Metrics can have labels, for example increment('retries_total', operation='head').
+class Metrics:
+	def __init__(self):
+		self.lock = threading.Lock()
+		# (name, labels) -> value
+		self.counters = dict()
+		# (name, labels) -> [count, sum, max]
+		self.observations = dict()
+	def increment(self, name, value=1, **labels):
+		key = (name, tuple(sorted(labels.items())))
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + value
+	def observe(self, name, value, **labels):
+		key = (name, tuple(sorted(labels.items())))
+		with self.lock:
+			observation = self.observations.get(key)
+			if observation is None:
+				self.observations[key] = [1, value, value]
+			else:
+				observation[0] += 1
+				observation[1] += value
+				observation[2] = max(observation[2], value)
+	def samples(self):
+		# Return a list of (name, labels, value) of every exported value
+		with self.lock:
+			result = [(name, labels, value) for (name, labels), value in self.counters.items()]
+			for (name, labels), (count, total, maximum) in self.observations.items():
+				result.append((name + '_count', labels, count))
+				result.append((name + '_sum', labels, total))
+				result.append((name + '_max', labels, maximum))
+		return sorted(result)
+	def prometheus_text(self):
+		lines = list()
+		for name, labels, value in self.samples():
+			if len(labels) > 0:
+				name += '{' + ','.join('{}="{}"'.format(key, str(label).replace('"', '\\"')) for key, label in labels) + '}'
+			lines.append('{} {}'.format(name, value))
+		return '\n'.join(lines) + '\n'
+	def json_line(self):
+		values = dict()
+		for name, labels, value in self.samples():
+			if len(labels) > 0:
+				name += '{' + ','.join('{}={}'.format(key, label) for key, label in labels) + '}'
+			values[name] = value
+		return json.dumps(dict(time=time.time(), metrics=values))
+
+# The metrics every module reports to
+registry = Metrics()
+
+def serve_prometheus(port, metrics=registry):
+	# Serve the metrics in the Prometheus text format on a background thread, return the server
+	class Handler(BaseHTTPRequestHandler):
+		def do_GET(self):
+			body = metrics.prometheus_text().encode()
+			self.send_response(200)
+			self.send_header('Content-Type', 'text/plain; version=0.0.4')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+		def log_message(self, format, *args):
+			pass
+	server = ThreadingHTTPServer(('', port), Handler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+def write_json_lines(filename, interval, metrics=registry):
+	# Append a json line with all metrics to filename every interval seconds on a background thread
+	def run():
+		while True:
+			time.sleep(interval)
+			with open(filename, 'a') as file:
+				file.write(metrics.json_line() + '\n')
+	thread = threading.Thread(target=run, daemon=True)
+	thread.start()
+	return thread
@@ -0,0 +1,203 @@
+# Retry policy shared by all Twitch requests
+
+from urllib.parse import urlparse
+import asyncio
+import logging
+import random
+import threading
+import time
+import requests
+
+import metrics
+
+
+# Tracks consecutive failures per host. After failure_threshold failures in a row the circuit
+# for that host opens and callers wait out the cooldown instead of sending more requests.
+# Failures of requests that were already in flight while the circuit is open are ignored.
+# After the cooldown a single trial request is let through while the others keep waiting.
+# If it fails the circuit opens again with a doubled cooldown up to max_cooldown, any success closes the circuit.
+class CircuitBreaker:
+	def __init__(self, failure_threshold=5, cooldown=5.0, max_cooldown=120.0):
+		self.failure_threshold = failure_threshold
+		self.cooldown = cooldown
+		self.max_cooldown = max_cooldown
+		self.lock = threading.Lock()
+		# host -> [consecutive failures, open until or 0.0 if closed, current cooldown, whether a trial request is out]
+		self.hosts = dict()
+	def acquire(self, host):
+		# Return (seconds to wait before asking again, trial) where trial is True
+		# if the caller may send the trial request after a cooldown
+		with self.lock:
+			state = self.hosts.get(host)
+			if state is None or state[1] == 0.0:
+				return 0.0, False
+			wait_time = state[1] - time.monotonic()
+			if wait_time > 0:
+				return wait_time, False
+			if state[3]:
+				# wait for the outcome of the trial request
+				return min(1.0, self.cooldown), False
+			state[3] = True
+			return 0.0, True
+	def wait(self, host):
+		# Block while the circuit for host is open, return whether the caller sends the trial request
+		while True:
+			wait_time, trial = self.acquire(host)
+			if wait_time <= 0:
+				return trial
+			logging.info('Circuit for {} is open, waiting {:.1f} seconds'.format(host, wait_time))
+			time.sleep(wait_time)
+	async def wait_async(self, host):
+		# Like wait but without blocking the event loop
+		while True:
+			wait_time, trial = self.acquire(host)
+			if wait_time <= 0:
+				return trial
+			logging.info('Circuit for {} is open, waiting {:.1f} seconds'.format(host, wait_time))
+			await asyncio.sleep(wait_time)
+	def success(self, host):
+		with self.lock:
+			self.hosts.pop(host, None)
+	def release(self, host, trial):
+		# The trial request ended without telling whether the host works, let another request try
+		if not trial:
+			return
+		with self.lock:
+			state = self.hosts.get(host)
+			if state is not None:
+				state[3] = False
+	def failure(self, host, trial=False):
+		with self.lock:
+			state = self.hosts.setdefault(host, [0, 0.0, self.cooldown, False])
+			if trial:
+				state[3] = False
+				state[2] = min(state[2] * 2, self.max_cooldown)
+			elif state[1] > 0.0:
+				# already open, the request was sent before it opened
+				return
+			else:
+				state[0] += 1
+				if state[0] < self.failure_threshold:
+					return
+			state[1] = time.monotonic() + state[2]
+			metrics.registry.increment('circuit_breaker_opened_total')
+			logging.warning('Opening circuit for {} for {:.1f} seconds after {} failures'.format(host, state[2], state[0]))
+
+# Decides whether and when a failed request is retried.
+# The first retry happens immediately because most failures are one-off, after that the delay grows
+# exponentially from base_delay up to max_delay with full jitter so clients do not retry in lockstep.
+# Connection problems, timeouts and the status codes in retryable_statuses are retried,
+# any other error is raised straight away. max_attempts of None retries forever.
+# A 404 is retried because Twitch sometimes answers with it for segments that exist, but only until
+# it was received not_found_attempts times, and it does not count against the host in the circuit breaker.
+class RetryPolicy:
+	def __init__(self, base_delay=0.5, max_delay=60.0, multiplier=2.0, max_attempts=None, immediate_first_retry=True,
+			retryable_statuses=(404, 408, 425, 429, 500, 502, 503, 504), not_found_attempts=3, breaker=None):
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		self.multiplier = multiplier
+		self.max_attempts = max_attempts
+		self.immediate_first_retry = immediate_first_retry
+		self.retryable_statuses = retryable_statuses
+		self.not_found_attempts = not_found_attempts
+		self.breaker = breaker
+	def delay(self, retry):
+		# retry is 1 for the first retry
+		if self.immediate_first_retry:
+			if retry == 1:
+				return 0.0
+			retry -= 1
+		return random.uniform(0, min(self.max_delay, self.base_delay * self.multiplier ** (retry - 1)))
+	def status(self, exception):
+		if isinstance(exception, requests.exceptions.HTTPError) and exception.response is not None:
+			return exception.response.status_code
+		return None
+	def is_retryable(self, exception):
+		status = self.status(exception)
+		if status is not None:
+			return status in self.retryable_statuses
+		return isinstance(exception, (
+			requests.exceptions.ConnectionError,
+			requests.exceptions.Timeout,
+			requests.exceptions.ChunkedEncodingError,
+			requests.exceptions.ContentDecodingError))
+	def gives_up(self, exception, attempts):
+		if not self.is_retryable(exception):
+			return True
+		if self.max_attempts is not None and attempts >= self.max_attempts:
+			return True
+		return self.status(exception) == 404 and attempts >= self.not_found_attempts
+	# call and call_async only differ in how they wait, the decisions are made by the methods below
+	def before_attempt(self, host):
+		# Return whether the attempt is the trial request of the circuit breaker
+		return self.breaker.wait(host) if self.breaker is not None else False
+	async def before_attempt_async(self, host):
+		return await self.breaker.wait_async(host) if self.breaker is not None else False
+	def attempt_succeeded(self, host):
+		if self.breaker is not None:
+			self.breaker.success(host)
+	def attempt_aborted(self, host, trial):
+		# The attempt ended with an exception that is not a request error
+		if self.breaker is not None:
+			self.breaker.release(host, trial)
+	def attempt_failed(self, host, trial, exception, attempts, description, operation):
+		# Record a failed attempt and return the delay before the next one or None to give up
+		if self.breaker is not None:
+			if self.is_retryable(exception) and self.status(exception) != 404:
+				self.breaker.failure(host, trial)
+			elif self.status(exception) is not None:
+				# the host answered
+				self.breaker.success(host)
+			else:
+				self.breaker.release(host, trial)
+		if self.gives_up(exception, attempts):
+			logging.error('Giving up on {} after {} attempts {}'.format(description, attempts, exception))
+			return None
+		delay = self.delay(attempts)
+		logging.warning('Encounted following exception while trying to {} {}, retrying in {:.1f} seconds'.format(description, exception, delay))
+		metrics.registry.increment('twitch_retries_total', operation=operation)
+		return delay
+	def call(self, function, uri, description, operation='request'):
+		# Call function until it succeeds or fails in a way that should not be retried.
+		# uri is used to find the host for the circuit breaker, description and operation for logging and metrics.
+		host = urlparse(uri).netloc
+		attempts = 0
+		while True:
+			trial = self.before_attempt(host)
+			try:
+				result = function()
+			except requests.exceptions.RequestException as e:
+				attempts += 1
+				delay = self.attempt_failed(host, trial, e, attempts, description, operation)
+				if delay is None:
+					raise
+				time.sleep(delay)
+				continue
+			except BaseException:
+				self.attempt_aborted(host, trial)
+				raise
+			self.attempt_succeeded(host)
+			return result
+	async def call_async(self, function, uri, description, operation='request'):
+		# Like call but function returns an awaitable and waiting does not block the event loop
+		host = urlparse(uri).netloc
+		attempts = 0
+		while True:
+			trial = await self.before_attempt_async(host)
+			try:
+				result = await function()
+			except requests.exceptions.RequestException as e:
+				attempts += 1
+				delay = self.attempt_failed(host, trial, e, attempts, description, operation)
+				if delay is None:
+					raise
+				await asyncio.sleep(delay)
+				continue
+			except BaseException:
+				self.attempt_aborted(host, trial)
+				raise
+			self.attempt_succeeded(host)
+			return result
+
+# Used by every TwitchIO that is not given its own policy
+default_policy = RetryPolicy(breaker=CircuitBreaker())
@@ -0,0 +1,77 @@
+# Helpers for running several transfers at the same time
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import logging
+import threading
+import time
+
+
+# Token bucket that limits the combined rate of all callers to bytes_per_second.
+# consume blocks until the bytes may be used. A single large consume is allowed to
+# overdraw the bucket, later callers then wait until the debt is paid off.
+class BandwidthLimiter:
+	def __init__(self, bytes_per_second, burst=None):
+		self.bytes_per_second = bytes_per_second
+		self.burst = burst if burst is not None else bytes_per_second
+		self.tokens = self.burst
+		self.last = time.monotonic()
+		self.lock = threading.Lock()
+	def consume(self, amount):
+		with self.lock:
+			now = time.monotonic()
+			self.tokens = min(self.burst, self.tokens + (now - self.last) * self.bytes_per_second)
+			self.last = now
+			self.tokens -= amount
+			wait_time = -self.tokens / self.bytes_per_second if self.tokens < 0 else 0
+		if wait_time > 0:
+			time.sleep(wait_time)
+
+# Runs jobs on a pool of worker threads.
+# Every worker thread creates its own context with worker_init, for example a YoutubeUploader
+# because those can not be shared between threads.
+# on_done is called from the calling thread in the order of the jobs, a job is only reported
+# once all jobs before it are finished too. This allows checkpoints to advance without ever
+# skipping a job that is still running or failed.
+# If a job raises no new jobs are started, the running ones are finished and the exception is re-raised.
+class OrderedScheduler:
+	def __init__(self, workers, worker_init=None):
+		self.workers = workers
+		self.worker_init = worker_init
+	def run(self, jobs, function, on_done=None):
+		# function is called as function(job, context) and its results are returned in job order
+		jobs = list(jobs)
+		local = threading.local()
+		def call(job):
+			if not hasattr(local, 'context'):
+				local.context = self.worker_init() if self.worker_init is not None else None
+			return function(job, local.context)
+		results = [None] * len(jobs)
+		finished = [False] * len(jobs)
+		next_job = 0
+		next_done = 0
+		error = None
+		with ThreadPoolExecutor(max_workers=self.workers) as executor:
+			futures = dict()
+			while True:
+				while error is None and next_job < len(jobs) and len(futures) < self.workers:
+					futures[executor.submit(call, jobs[next_job])] = next_job
+					next_job += 1
+				if len(futures) == 0:
+					break
+				done, _ = wait(futures, return_when=FIRST_COMPLETED)
+				for future in done:
+					i = futures.pop(future)
+					try:
+						results[i] = future.result()
+						finished[i] = True
+					except Exception as e:
+						logging.error('Job {} failed with {}'.format(jobs[i], e))
+						if error is None:
+							error = e
+				while next_done < len(jobs) and finished[next_done]:
+					if on_done is not None:
+						on_done(jobs[next_done], results[next_done])
+					next_done += 1
+		if error is not None:
+			raise error
+		return results
@@ -0,0 +1,133 @@
+# Cache for downloaded chunks of a TwitchIO
+
+import collections
+import hashlib
+import logging
+import os
+import threading
+import metrics
+
+
+# Keeps downloaded chunks in memory up to max_bytes and evicts the least recently used ones.
+# If spill_directory is set evicted chunks are written there instead of being dropped
+# and are read back from disk when they are needed again, up to max_spill_bytes.
+# Chunks are keyed by their uri so one cache can be shared between a video and its parts.
+# The counters make it possible to size the cache against how often chunks are requested again,
+# bytes_refetched counts the bytes of chunks that had to be downloaded again after they were evicted.
+class SegmentCache:
+	def __init__(self, max_bytes=64*2**20, spill_directory=None, max_spill_bytes=4*2**30):
+		self.max_bytes = max_bytes
+		self.spill_directory = spill_directory
+		self.max_spill_bytes = max_spill_bytes
+		if spill_directory is not None:
+			os.makedirs(spill_directory, exist_ok=True)
+		self.lock = threading.Lock()
+		self.chunks = collections.OrderedDict()
+		self.bytes = 0
+		# uri -> size of chunks on disk
+		self.spilled = collections.OrderedDict()
+		self.spilled_bytes = 0
+		# every uri that was ever put into the cache
+		self.seen = set()
+		self.hits = 0
+		self.misses = 0
+		self.spill_hits = 0
+		self.evictions = 0
+		self.spill_evictions = 0
+		self.bytes_refetched = 0
+	def __contains__(self, uri):
+		with self.lock:
+			return uri in self.chunks or uri in self.spilled
+	def get(self, uri):
+		with self.lock:
+			chunk = self.chunks.get(uri)
+			if chunk is not None:
+				self.chunks.move_to_end(uri)
+				self.hits += 1
+				metrics.registry.increment('segment_cache_hits_total')
+				return chunk
+			if uri in self.spilled:
+				chunk = self.unspill(uri)
+				if chunk is not None:
+					self.hits += 1
+					self.spill_hits += 1
+					metrics.registry.increment('segment_cache_hits_total')
+					metrics.registry.increment('segment_cache_spill_hits_total')
+					self.insert(uri, chunk)
+					return chunk
+			self.misses += 1
+			metrics.registry.increment('segment_cache_misses_total')
+			return None
+	def put(self, uri, chunk):
+		with self.lock:
+			if uri in self.chunks:
+				return
+			if uri in self.seen:
+				self.bytes_refetched += len(chunk)
+				metrics.registry.increment('segment_cache_refetched_bytes_total', len(chunk))
+			self.seen.add(uri)
+			self.insert(uri, chunk)
+	def insert(self, uri, chunk):
+		self.chunks[uri] = chunk
+		self.bytes += len(chunk)
+		# The newest chunk is always kept even if it is larger than max_bytes because it is about to be read
+		while self.bytes > self.max_bytes and len(self.chunks) > 1:
+			old_uri, old_chunk = self.chunks.popitem(last=False)
+			self.bytes -= len(old_chunk)
+			self.evictions += 1
+			metrics.registry.increment('segment_cache_evictions_total')
+			if self.spill_directory is not None:
+				self.spill(old_uri, old_chunk)
+	def spill_path(self, uri):
+		return os.path.join(self.spill_directory, hashlib.sha1(uri.encode()).hexdigest())
+	def spill(self, uri, chunk):
+		if len(chunk) > self.max_spill_bytes:
+			return
+		while self.spilled and self.spilled_bytes + len(chunk) > self.max_spill_bytes:
+			old_uri, old_size = self.spilled.popitem(last=False)
+			self.spilled_bytes -= old_size
+			self.spill_evictions += 1
+			self.remove_spill_file(old_uri)
+		try:
+			with open(self.spill_path(uri), 'wb') as file:
+				file.write(chunk)
+		except OSError as e:
+			logging.warning('Could not spill chunk {} to disk {}'.format(uri, e))
+			return
+		self.spilled[uri] = len(chunk)
+		self.spilled_bytes += len(chunk)
+	def unspill(self, uri):
+		self.spilled_bytes -= self.spilled.pop(uri)
+		try:
+			with open(self.spill_path(uri), 'rb') as file:
+				chunk = file.read()
+		except OSError as e:
+			logging.warning('Could not read spilled chunk {} from disk {}'.format(uri, e))
+			return None
+		finally:
+			self.remove_spill_file(uri)
+		return chunk
+	def remove_spill_file(self, uri):
+		try:
+			os.remove(self.spill_path(uri))
+		except OSError:
+			pass
+	def clear(self):
+		with self.lock:
+			self.chunks.clear()
+			self.bytes = 0
+			for uri in self.spilled:
+				self.remove_spill_file(uri)
+			self.spilled.clear()
+			self.spilled_bytes = 0
+	def stats(self):
+		with self.lock:
+			return {
+				'hits': self.hits,
+				'misses': self.misses,
+				'spill_hits': self.spill_hits,
+				'evictions': self.evictions,
+				'spill_evictions': self.spill_evictions,
+				'bytes_refetched': self.bytes_refetched,
+				'bytes': self.bytes,
+				'spilled_bytes': self.spilled_bytes }
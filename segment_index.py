@@ -0,0 +1,143 @@
+# Compact index of the segments of a video
+
+from array import array
+import bisect
+import itertools
+import os
+import re
+
+from index_store import Segment
+
+
+# Twitch puts start_offset and end_offset next to each other, other orders are only found by the slower fallback
+offsets_pattern = re.compile(r'[?&]start_offset=(\d+)&end_offset=(\d+)(?![^&\n])')
+start_offset_pattern = re.compile(r'[?&]start_offset=(\d+)(?![^&])')
+end_offset_pattern = re.compile(r'[?&]end_offset=(\d+)(?![^&])')
+
+def parse_sizes(uris):
+	# Return the size of every segment from the start_offset and end_offset of its uri, None if it has none.
+	# All uris are matched with one pass of a regular expression over the joined uris,
+	# only if some of them lack offsets every uri is parsed on its own.
+	offsets = offsets_pattern.findall('\n'.join(uris))
+	if len(offsets) == len(uris):
+		return [int(end) - int(start) + 1 for start, end in offsets] # + 1 because those ranges are inclusive
+	sizes = list()
+	for uri in uris:
+		start = start_offset_pattern.search(uri)
+		end = end_offset_pattern.search(uri)
+		sizes.append(int(end.group(1)) - int(start.group(1)) + 1 if start is not None and end is not None else None)
+	return sizes
+
+# Storage shared by a SegmentIndex and all its parts.
+# uris are split into the prefix all of them share and their suffixes, which are stored back to back
+# as utf-8 in one bytearray with their end positions in suffix_ends.
+# offsets and times hold the cumulative sizes and durations with a leading 0.
+class IndexData:
+	def __init__(self):
+		self.prefix = None
+		self.suffixes = bytearray()
+		self.suffix_ends = array('q', [0])
+		self.offsets = array('q', [0])
+		self.times = array('d', [0.0])
+	def __len__(self):
+		return len(self.suffix_ends) - 1
+	def suffix(self, i):
+		return self.suffixes[self.suffix_ends[i]:self.suffix_ends[i + 1]].decode()
+	def append(self, uris, durations, sizes):
+		uris = list(uris)
+		if len(uris) == 0:
+			return
+		prefix = os.path.commonprefix(uris if self.prefix is None else [self.prefix] + uris)
+		if self.prefix is not None and prefix != self.prefix:
+			# rare, the new uris do not share the whole prefix so the old suffixes are stored again
+			old_uris = [self.prefix + self.suffix(i) for i in range(len(self))]
+			self.suffixes = bytearray()
+			self.suffix_ends = array('q', [0])
+			uris = old_uris + uris
+		self.prefix = prefix
+		encoded = [uri[len(prefix):].encode() for uri in uris]
+		self.suffixes += b''.join(encoded)
+		self.suffix_ends.extend(itertools.islice(itertools.accumulate(map(len, encoded), initial=self.suffix_ends[-1]), 1, None))
+		self.offsets.extend(itertools.islice(itertools.accumulate(sizes, initial=self.offsets[-1]), 1, None))
+		self.times.extend(itertools.islice(itertools.accumulate(durations, initial=self.times[-1]), 1, None))
+
+# Read only view of a cumulative array of an IndexData, item i is the end of segment first + i
+# minus the start of segment first, so it behaves like the offset_index and time_index lists did.
+class CumulativeView:
+	def __init__(self, values, first, last):
+		self.values = values
+		self.first = first
+		self.last = last
+	def __len__(self):
+		return self.last - self.first
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return [self[j] for j in range(*i.indices(len(self)))]
+		if i < 0:
+			i += len(self)
+		if i < 0 or i >= len(self):
+			raise IndexError('index out of range')
+		return self.values[self.first + i + 1] - self.values[self.first]
+	def __iter__(self):
+		return (self[i] for i in range(len(self)))
+	def bisect(self, value, lo=0):
+		# bisect.bisect_right over the view without boxing every item
+		base = self.values[self.first]
+		return bisect.bisect_right(self.values, value + base, self.first + 1 + lo, self.last + 1) - self.first - 1
+
+# Sequence of the segments [first, last) of an IndexData with their byte offsets and times.
+# Items are Segment tuples created on access. Slicing returns another SegmentIndex over the same
+# storage without copying, so the parts of a video cost a few integers each.
+class SegmentIndex:
+	def __init__(self, data, first=0, last=None):
+		self.data = data
+		self.first = first
+		self.last = last if last is not None else len(data)
+	def from_segments(segments, sizes):
+		# segments are objects with uri and duration, like the m3u8 segments, and sizes their sizes in bytes
+		index = SegmentIndex(IndexData())
+		index.append(segments, sizes)
+		return index
+	def append(self, segments, sizes):
+		# Add segments to the end, only possible for an index that reaches the end of its storage
+		if self.last != len(self.data):
+			raise RuntimeError('Cannot append to a part of a segment index')
+		segments = list(segments)
+		self.data.append([segment.uri for segment in segments], [segment.duration for segment in segments], sizes)
+		self.last = len(self.data)
+	def __len__(self):
+		return self.last - self.first
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			start, stop, step = i.indices(len(self))
+			if step != 1:
+				raise ValueError('SegmentIndex slices must be contiguous')
+			return SegmentIndex(self.data, self.first + start, self.first + max(start, stop))
+		if i < 0:
+			i += len(self)
+		if i < 0 or i >= len(self):
+			raise IndexError('index out of range')
+		return Segment(self.uri(i), self.duration(i))
+	def __iter__(self):
+		return (self[i] for i in range(len(self)))
+	def uri(self, i):
+		return self.data.prefix + self.data.suffix(self.first + i)
+	def duration(self, i):
+		return self.data.times[self.first + i + 1] - self.data.times[self.first + i]
+	def chunk_size(self, i):
+		return self.data.offsets[self.first + i + 1] - self.data.offsets[self.first + i]
+	@property
+	def size(self):
+		return self.data.offsets[self.last] - self.data.offsets[self.first]
+	@property
+	def total_duration(self):
+		return self.data.times[self.last] - self.data.times[self.first]
+	def segment_at(self, offset):
+		# Index of the segment containing the byte offset, counted from the start of this index
+		return bisect.bisect_right(self.data.offsets, offset + self.data.offsets[self.first], self.first + 1, self.last + 1) - self.first - 1
+	@property
+	def offset_index(self):
+		return CumulativeView(self.data.offsets, self.first, self.last)
+	@property
+	def time_index(self):
+		return CumulativeView(self.data.times, self.first, self.last)
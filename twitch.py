@@ -1,11 +1,23 @@
 import argparse
+import twitch_playlist
 import subprocess
 import requests
 import os
 import io
+import time
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
-from youtube import YoutubeUploader
+from youtube import YoutubeUploader, UploadSessionStore
 from TwitchIO import TwitchIO
+from segment_cache import SegmentCache
+from index_store import IndexStore
+from job_queue import JobQueue
+from scheduler import BandwidthLimiter, OrderedScheduler
+import metrics
+import http_pool
+import retry
 
 headers_v3 = {
     'Accept': 'application/vnd.twitchtv.v3+json',
@@ -30,14 +42,19 @@ def json_to_video( json ):
 def get_video( id ):
 # Return a video in the internal format. The video is specified by its video id according to the Twitch api.
 	url = 'https://api.twitch.tv/kraken/videos/{}'.format( id )
-	r = requests.get( url, headers=headers_v3 )
+	r = http_pool.shared_session().get( url, headers=headers_v3 )
+	r.raise_for_status()
 	json = r.json()
 	return json_to_video( json )
 
 
-def get_videos( channel_name, last_video=None ):
-	#last video is none or the id of a video
-	#if it is not none only videos that come before last video are returned
+def iter_videos( channel_name, last_video=None, recorded_after=None, concurrency=4, include_recording=False ):
+	# Generator over the videos of a channel from newest to oldest so processing can start on the first page.
+	# Stops before the video with id last_video or before the first video recorded before recorded_after,
+	# which is a timestamp in the same format as recorded_at.
+	# Videos that are still recording are skipped unless include_recording is True.
+	# The first page tells the total number of videos, the remaining pages are then requested
+	# up to concurrency at a time and pages that are not needed anymore are cancelled.
 	url = 'https://api.twitch.tv/kraken/channels/{}/videos'.format( channel_name )
 	videos_per_page = 100 #100 is the maximum videos we can request per call
 	payload = { 'limit': videos_per_page,
@@ -47,28 +64,53 @@ def get_videos( channel_name, last_video=None ):
 	def get_page( pagenumber ):
 		_payload = payload.copy()
 		_payload['offset'] = pagenumber * videos_per_page
-		r = requests.get( url, params=_payload, headers=headers_v3)
+		r = http_pool.shared_session().get( url, params=_payload, headers=headers_v3)
 		json = r.json()
-		videos = json['videos']
-		result = []
-		for v in videos:
-			video = json_to_video( v )
-			if video['status'] != 'recording':
-				result.append(video) #Skip a video if it is currently live
-			else:
-				print('Skipped video {} because it is still recording aka live'.format(video['id']))
-		return result
-	videos = []
-	index = 0
-	page = get_page( index )
-	while len(page) > 0:
-		for v in page:
-			if last_video != None and v['id'] == last_video:
-				return videos
-			videos.append( v )
-		index += 1
-		page = get_page( index )
-	return videos
+		return json.get('_total'), [json_to_video( v ) for v in json['videos']]
+	def get_pages():
+		total, page = get_page( 0 )
+		yield page
+		if total is None:
+			index = 1
+			while len(page) > 0:
+				total, page = get_page( index )
+				yield page
+				index += 1
+			return
+		page_count = (total + videos_per_page - 1) // videos_per_page
+		with ThreadPoolExecutor(max_workers=concurrency) as executor:
+			futures = collections.deque()
+			next_page = 1
+			try:
+				while next_page < page_count or len(futures) > 0:
+					while next_page < page_count and len(futures) < concurrency:
+						futures.append(executor.submit(get_page, next_page))
+						next_page += 1
+					yield futures.popleft().result()[1]
+			finally:
+				for future in futures:
+					future.cancel()
+	pages = get_pages()
+	try:
+		for page in pages:
+			if len(page) == 0:
+				return
+			for video in page:
+				if last_video != None and video['id'] == last_video:
+					return
+				if recorded_after != None and video['recorded_at'] < recorded_after:
+					return
+				if video['status'] == 'recording' and not include_recording:
+					print('Skipped video {} because it is still recording aka live'.format(video['id'])) #Skip a video if it is currently live
+					continue
+				yield video
+	finally:
+		pages.close()
+
+def get_videos( channel_name, last_video=None, recorded_after=None, include_recording=False ):
+	#last video is none or the id of a video
+	#if it is not none only videos that come before last video are returned
+	return list( iter_videos( channel_name, last_video, recorded_after, include_recording=include_recording ) )
 
 def get_video_title(video, part_number=None):
 	title = '{} from {}'.format(video['title'], video['recorded_at'])
@@ -76,7 +118,17 @@ def get_video_title(video, part_number=None):
 		title += ' part {}'.format( part_number )
 	return title
 
-def upload_video( video, args, youtube_uploader):
+index_store = None
+bandwidth_limiter = None
+download_slots = None
+upload_session_store = None
+# EventLoopThread of the async backend, None if the blocking TwitchIO is used
+event_loop_thread = None
+
+def upload_video( video, args, youtube_uploader, job_queue=None ):
+	# If job_queue is given the parts of the video and their Youtube ids are recorded in it
+	# and parts that were uploaded by an earlier attempt are not uploaded again.
+	start = time.monotonic()
 	if args.dont_use_default_tags:
 		tags = args.tags.split(",")
 	else:
@@ -88,47 +140,307 @@ def upload_video( video, args, youtube_uploader):
 		video['recorded_at'], video['id'] )
 
 	print('Creating TwitchIO for', video['id'])
-	twitchio = TwitchIO.from_twitch(video['id'][1:], headers=headers_v3)
-	print('Video has size {}, real duration {}, twitch duration {}.'.format(twitchio.size, twitchio.duration, video['length']))
-	if twitchio.size == 0 or twitchio.duration == 0.0:
-		print('Skipping video because size or duration is 0.')
-		return
-	if twitchio.size > args.max_size or twitchio.duration > args.max_duration:
-		if twitchio.size > args.max_size: print('Video is over size limit of {}.'.format(args.max_size))
-		if twitchio.duration > args.max_duration: print('Video is over duration limit of {}.'.format(args.max_duration))
-		parts = [i for i in twitchio.split_parts(args.max_size, args.max_duration)]
-		print('Therefore splitting in {} parts.'.format(len(parts)))
-		if not args.dont_use_playlist:
-			playlist_id = youtube_uploader.create_playlist(get_video_title(video), privacyStatus=args.privacy)['id']
-			print('Created playlist with id {} for parts.'.format(playlist_id))
-		for i, part in enumerate(parts):
-			part_title = title + ' part {}'.format(i+1)
-			media_body = YoutubeUploader.iobase_to_media_body(part)
-			print('Starting upload of part {}.'.format(i))
-			youtube_video_id = youtube_uploader.upload(media_body, part_title, description, "20", tags, args.privacy)
-			print('Finished uploading part as {}.'.format(youtube_video_id))
+	cache = SegmentCache(args.cache_memory, args.cache_spill_directory)
+	if event_loop_thread is not None:
+		twitchio = SyncTwitchIO.from_twitch(video['id'][1:], event_loop_thread, headers=headers_v3, prefetch=args.prefetch, prefetch_memory=args.prefetch_memory, cache=cache, index_workers=args.index_workers, index_store=index_store)
+	else:
+		twitchio = TwitchIO.from_twitch(video['id'][1:], headers=headers_v3, prefetch=args.prefetch, prefetch_memory=args.prefetch_memory, cache=cache, index_workers=args.index_workers, index_store=index_store, limiter=bandwidth_limiter, download_slots=download_slots)
+	# the TwitchIOs and their prefetch threads are closed even if the upload fails
+	parts = list()
+	try:
+		print('Video has size {}, real duration {}, twitch duration {}.'.format(twitchio.size, twitchio.duration, video['length']))
+		if twitchio.size == 0 or twitchio.duration == 0.0:
+			print('Skipping video because size or duration is 0.')
+			return
+		plan = twitchio.plan_parts(args.max_size, args.max_duration)
+		if job_queue is not None and not args.dry_run:
+			# an earlier attempt may already have uploaded parts of its plan
+			plan = job_queue.plan(video['id'], plan)
+		if args.dry_run:
+			print('Dry run, video would be uploaded as:')
+			print(plan.describe())
+			return
+		if len(plan) > 1:
+			if twitchio.size > args.max_size: print('Video is over size limit of {}.'.format(args.max_size))
+			if twitchio.duration > args.max_duration: print('Video is over duration limit of {}.'.format(args.max_duration))
+			parts = [i for i in twitchio.split_parts(plan=plan)]
+			print('Therefore splitting in {} parts.'.format(len(parts)))
 			if not args.dont_use_playlist:
+				playlist_id = job_queue.playlist_id(video['id']) if job_queue is not None else None
+				if playlist_id is None:
+					playlist_id = youtube_uploader.create_playlist(get_video_title(video), privacyStatus=args.privacy)['id']
+					print('Created playlist with id {} for parts.'.format(playlist_id))
+					if job_queue is not None:
+						job_queue.set_playlist_id(video['id'], playlist_id)
+			def upload_part(i, uploader):
+				if job_queue is not None:
+					state, youtube_video_id, _ = job_queue.part(video['id'], i)
+					if state == JobQueue.DONE:
+						print('Part {} was already uploaded as {}.'.format(i, youtube_video_id))
+						return youtube_video_id
+					job_queue.start_part(video['id'], i)
+				part_title = title + ' part {}'.format(i+1)
+				media_body = YoutubeUploader.iobase_to_media_body(parts[i], args.upload_chunk_size, args.adaptive_chunk_size)
+				print('Starting upload of part {}.'.format(i))
+				try:
+					youtube_video_id = uploader.upload(media_body, part_title, description, "20", tags, args.privacy,
+						session_store=upload_session_store, session_key='{} part {}'.format(video['id'], i+1))
+				except Exception:
+					if job_queue is not None:
+						job_queue.fail_part(video['id'], i)
+					raise
+				finally:
+					parts[i].close()
+				print('Finished uploading part as {}.'.format(youtube_video_id))
+				if job_queue is not None:
+					job_queue.finish_part(video['id'], i, youtube_video_id)
+				return youtube_video_id
+			def part_done(i, youtube_video_id):
+				# Called in part order so the playlist order does not depend on which part finishes first
+				if args.dont_use_playlist or (job_queue is not None and job_queue.part(video['id'], i)[2]):
+					return
 				youtube_uploader.add_to_playlist(playlist_id, youtube_video_id)
+				if job_queue is not None:
+					job_queue.set_part_in_playlist(video['id'], i)
+			if args.parallel_parts > 1:
+				scheduler = OrderedScheduler(args.parallel_parts, lambda: YoutubeUploader(args.authentication_file, args.client_secrets_file))
+				scheduler.run(range(len(parts)), upload_part, part_done)
+			else:
+				for i in range(len(parts)):
+					part_done(i, upload_part(i, youtube_uploader))
+		elif job_queue is not None and job_queue.part(video['id'], 0)[0] == JobQueue.DONE:
+			print('Video {} was already uploaded as {}.'.format(video['id'], job_queue.part(video['id'], 0)[1]))
+		else:
+			media_body = YoutubeUploader.iobase_to_media_body(twitchio, args.upload_chunk_size, args.adaptive_chunk_size)
+			print("Starting upload")
+			youtube_video_id = youtube_uploader.upload(media_body, title, description, "20", tags, args.privacy,
+				session_store=upload_session_store, session_key=video['id'])
+			print( "Done uploading", video['id'], "as", youtube_video_id )
+			if job_queue is not None:
+				job_queue.finish_part(video['id'], 0, youtube_video_id)
+		print('Chunk cache statistics {}.'.format(cache.stats()))
+		metrics.registry.increment('videos_uploaded_total')
+		metrics.registry.observe('video_wall_seconds', time.monotonic() - start)
+	finally:
+		for part in parts:
+			part.close()
+		twitchio.close()
+		cache.clear()
+
+def follow_state_key( video ):
+	return '{} follow'.format( video['id'] )
+
+def follow_video( video, args, youtube_uploader ):
+	# Upload a video that is still recording while it grows.
+	# The source playlist is polled every args.follow_interval seconds and new segments are appended to the index.
+	# As soon as the segments after the last uploaded part fill a whole part of at most max_size bytes and
+	# max_duration seconds that part is sealed and uploaded. When the recording ends the rest is uploaded,
+	# as a single video if nothing was uploaded before.
+	# Polls are retried like segment downloads. With an upload session store the uploaded parts are recorded
+	# after each of them, so a restarted follow continues after the last uploaded part.
+	if args.dont_use_default_tags:
+		tags = args.tags.split(",")
 	else:
-		media_body = YoutubeUploader.iobase_to_media_body(twitchio)
-		print("Starting upload")
-		youtube_video_id = youtube_uploader.upload(media_body, title, description, "20", tags, args.privacy)
-		print( "Done uploading", video['id'], "as", youtube_video_id )
+		tags = default_tags + args.tags.split(",")
+	title = get_video_title(video)
+	description = 'Original title: {}\nOriginal description: {}\nOriginal date: {}\nOriginal Twitch id: {}'.format(
+		video['title'],
+		video['description'],
+		video['recorded_at'], video['id'] )
+	video_id = video['id'][1:]
+	print('Following', video['id'], 'while it is recording')
+	def get_playlist():
+		return retry.default_policy.call(lambda: twitch_playlist.get_source_playlist(video_id, headers_v3),
+			twitch_playlist.twitch_usher_url, 'get playlist of video {}'.format(video['id']), 'playlist')
+	def get_status():
+		return retry.default_policy.call(lambda: get_video(video['id'])['status'],
+			'https://api.twitch.tv', 'get status of video {}'.format(video['id']), 'video')
+	store = upload_session_store if not args.dry_run else None
+	state = store.get(follow_state_key(video)) if store is not None else None
+	# index of the first segment that is not uploaded yet
+	uploaded = state['uploaded'] if state is not None else 0
+	part_number = state['part_number'] if state is not None else 0
+	playlist_id = state['playlist_id'] if state is not None else None
+	if uploaded > 0:
+		print('Continuing after part {} at segment {}.'.format(part_number, uploaded))
+	cache = SegmentCache(args.cache_memory, args.cache_spill_directory)
+	playlist = get_playlist()
+	twitchio = TwitchIO(playlist.segments, prefetch=args.prefetch, prefetch_memory=args.prefetch_memory, cache=cache, index_workers=args.index_workers, limiter=bandwidth_limiter, download_slots=download_slots)
+	try:
+		def append_new_segments(playlist):
+			# Add the segments of playlist that are not in the index yet and return how many there were
+			new_segments = playlist.segments[len(twitchio.segments):]
+			if len(new_segments) > 0:
+				twitchio.append_segments(new_segments, args.index_workers)
+				print('Video {} grew to {} segments, {} bytes.'.format(video['id'], len(twitchio.segments), twitchio.size))
+			return len(new_segments)
+		grew = True
+		while True:
+			ended = playlist.is_endlist
+			if not ended and not grew and get_status() != 'recording':
+				# Some recordings end without the playlist being marked as complete.
+				# The playlist is fetched once more because it can have grown since the last poll.
+				playlist = get_playlist()
+				append_new_segments(playlist)
+				ended = True
+			remaining = twitchio.part(uploaded, len(twitchio.segments))
+			plan = remaining.plan_parts(args.max_size, args.max_duration, balanced=ended)
+			remaining.close()
+			sealed = plan.parts if ended else plan.parts[:-1]
+			single = ended and part_number == 0 and len(sealed) == 1
+			for part in sealed:
+				if part.last == part.first:
+					continue
+				part_number += 1
+				part_title = title
+				if not single:
+					part_title = title + ' part {}'.format(part_number)
+				if args.dry_run:
+					print('Dry run, would upload segments {} to {} as {}.'.format(uploaded + part.first, uploaded + part.last - 1, part_title))
+					continue
+				if not single and playlist_id is None and not args.dont_use_playlist:
+					playlist_id = youtube_uploader.create_playlist(title, privacyStatus=args.privacy)['id']
+					print('Created playlist with id {} for parts.'.format(playlist_id))
+				part_twitchio = twitchio.part(uploaded + part.first, uploaded + part.last)
+				try:
+					media_body = YoutubeUploader.iobase_to_media_body(part_twitchio, args.upload_chunk_size, args.adaptive_chunk_size)
+					print('Starting upload of part {} with {} bytes.'.format(part_number, part.size))
+					youtube_video_id = youtube_uploader.upload(media_body, part_title, description, "20", tags, args.privacy,
+						session_store=upload_session_store, session_key='{} part {}'.format(video['id'], part_number))
+				finally:
+					part_twitchio.close()
+				print('Finished uploading part as {}.'.format(youtube_video_id))
+				if playlist_id is not None:
+					youtube_uploader.add_to_playlist(playlist_id, youtube_video_id)
+				if store is not None:
+					store.update(follow_state_key(video), uploaded=uploaded + part.last, part_number=part_number, playlist_id=playlist_id)
+			if len(sealed) > 0:
+				uploaded += sealed[-1].last
+			if ended:
+				break
+			time.sleep(args.follow_interval)
+			playlist = get_playlist()
+			# the status is only checked once the playlist stopped growing
+			grew = append_new_segments(playlist) > 0
+		if store is not None:
+			store.remove(follow_state_key(video))
+		print('Chunk cache statistics {}.'.format(cache.stats()))
+		metrics.registry.increment('videos_uploaded_total')
+	finally:
+		twitchio.close()
+		cache.clear()
 
-def process_single_video( video, youtube_uploader, args ):
-	# TODO splitting
-	upload_video( video, args, youtube_uploader )
-	if args.state_file:
+def write_state( video, args ):
+	if args.state_file and not args.dry_run:
 		with open( args.state_file, 'w' ) as state_file:
 			state_file.writelines( [video['id'] + '\n'] )
 
+def transfer_video( video, args, youtube_uploader ):
+	# a follow that was interrupted is continued even if the recording ended in the meantime
+	followed = upload_session_store is not None and upload_session_store.get( follow_state_key( video ) ) is not None
+	if args.follow and (video['status'] == 'recording' or followed):
+		follow_video( video, args, youtube_uploader )
+	else:
+		upload_video( video, args, youtube_uploader )
+
+def process_single_video( video, youtube_uploader, args ):
+	transfer_video( video, args, youtube_uploader )
+	write_state( video, args )
+
+def process_videos( videos, args ):
+	# Uploads up to args.workers videos at the same time, each worker thread has its own YoutubeUploader.
+	# The state file only advances past a video once it and all older videos are done.
+	scheduler = OrderedScheduler(args.workers, lambda: YoutubeUploader(args.authentication_file, args.client_secrets_file))
+	scheduler.run(videos,
+		lambda video, youtube_uploader: transfer_video( video, args, youtube_uploader ),
+		lambda video, result: write_state( video, args ))
+
+def poll_channels( job_queue, channels, args ):
+	# Queue the videos of channels that are not queued yet.
+	# Only the videos newer than the newest one of the last complete listing are requested,
+	# that one is updated after the listing of a channel went through completely.
+	for channel in channels:
+		newest_video_id = None
+		try:
+			for video in iter_videos( channel, job_queue.newest_video_id( channel ), args.recorded_after ):
+				if newest_video_id is None:
+					newest_video_id = video['id']
+				if args.game_filter != None and video['game'] != args.game_filter:
+					continue
+				if job_queue.add_video( channel, video ):
+					print('Queued video', video['id'], 'of', channel)
+		except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+			print('Listing videos of {} failed, trying again on the next poll: {}'.format(channel, e))
+			continue
+		if newest_video_id is not None:
+			job_queue.set_newest_video_id( channel, newest_video_id )
+
+def run_daemon( job_queue, args ):
+	# Poll the comma separated channels of args.destination_id every args.poll_interval seconds
+	# and upload queued videos with args.workers threads until interrupted.
+	# The first interrupt lets the workers finish the videos they are uploading, a second one
+	# puts those videos back in the queue without counting the attempt and stops right away.
+	# Returns whether all workers stopped, only then the job queue may be closed.
+	channels = [channel for channel in args.destination_id.split(',') if channel]
+	if args.dry_run:
+		poll_channels( job_queue, channels, args )
+		print('Dry run, only queued new videos. Job queue {}.'.format(job_queue.stats()))
+		return True
+	stop = threading.Event()
+	wake = threading.Event()
+	running = set()
+	running_lock = threading.Lock()
+	def work():
+		youtube_uploader = YoutubeUploader(args.authentication_file, args.client_secrets_file)
+		while not stop.is_set():
+			video = job_queue.claim()
+			if video is None:
+				wake.wait(args.poll_interval)
+				continue
+			with running_lock:
+				running.add(video['id'])
+			try:
+				upload_video( video, args, youtube_uploader, job_queue )
+			except Exception as e:
+				state = job_queue.fail( video['id'], repr(e) )
+				print('Uploading video {} failed, it is now {}: {!r}'.format(video['id'], state, e))
+			else:
+				job_queue.finish( video['id'] )
+			finally:
+				with running_lock:
+					running.discard(video['id'])
+	workers = [threading.Thread(target=work, daemon=True) for _ in range(args.workers)]
+	for worker in workers:
+		worker.start()
+	try:
+		while True:
+			poll_channels( job_queue, channels, args )
+			wake.set()
+			wake.clear()
+			print('Job queue {}.'.format(job_queue.stats()))
+			time.sleep(args.poll_interval)
+	except KeyboardInterrupt:
+		stop.set()
+		wake.set()
+	try:
+		print('Stopping after the videos that are being uploaded, interrupt again to stop right away.')
+		for worker in workers:
+			worker.join()
+		return True
+	except KeyboardInterrupt:
+		with running_lock:
+			for video_id in running:
+				job_queue.release( video_id )
+		print('Stopped, videos that were being uploaded will be continued on the next start.')
+		return False
+
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser( description='Automatically upload twitch vods to youtube.' )
 	parser.add_argument( '--authentication-file', help='The file used to authenticate with youtube.', required=True )
 	parser.add_argument( '--client-secrets-file', help='Youtube developer api client secrets file. Only needed if auth file is not valid anymore.', required=False )
 	parser.add_argument( '--state-file', help='The file that contains the state for channel uploads.' )
-	parser.add_argument( '--upload-type', choices=['channel', 'video'], help='Upload a whole channel or a single video.', required=True )
-	parser.add_argument( '--destination-id', help='Channel or video id of location to be processed.', required=True )
+	parser.add_argument( '--upload-type', choices=['channel', 'video', 'daemon'], help='Upload a whole channel, a single video or keep mirroring channels.', required=True )
+	parser.add_argument( '--destination-id', help='Channel or video id of location to be processed, in daemon mode comma separated channels.', required=True )
 	parser.add_argument( '--tags', help='Addtional tags for the uploaded videos, comma separated.', default='')
 	parser.add_argument( '--dont-use-default-tags', help='Do not add the default tags to the video.', action='store_true' )
 	parser.add_argument( '--start-after', help='When in channel mode process only recordings newer than this video id' )
@@ -138,9 +450,60 @@ if __name__ == "__main__":
 	parser.add_argument( '--dont-use-playlist', help='Do not automatically create a playlist for videos that get split in multiple parts.', action='store_true')
 	parser.add_argument( '--privacy', help='Upload videos as public, unlisted or private', choices=['public', 'unlisted', 'private'], default='private')
 	parser.add_argument( '--game-filter', help='When in channel mode, upload only videos where game matches.', required=False)
+	parser.add_argument( '--prefetch', help='Number of video chunks to download in the background ahead of the upload.', type=int, default=4 )
+	parser.add_argument( '--prefetch-memory', help='Maximum number of bytes used by chunks downloaded ahead of the upload.', type=int, default=256*(2**20) )
+	parser.add_argument( '--cache-memory', help='Maximum number of bytes of downloaded video chunks kept in memory.', type=int, default=64*(2**20) )
+	parser.add_argument( '--cache-spill-directory', help='Directory where video chunks evicted from memory are kept until they are needed again.', required=False )
+	parser.add_argument( '--index-workers', help='Number of concurrent requests used to find the chunk sizes of older videos.', type=int, default=16 )
+	parser.add_argument( '--index-cache', help='File in which the chunk index of videos is kept between runs.', required=False )
+	parser.add_argument( '--workers', help='When in channel mode, number of videos uploaded at the same time.', type=int, default=1 )
+	parser.add_argument( '--bandwidth-limit', help='Maximum combined download rate of all uploads in bytes per second.', type=int, required=False )
+	parser.add_argument( '--parallel-parts', help='Number of parts of a split video uploaded at the same time.', type=int, default=1 )
+	parser.add_argument( '--max-downloads', help='Maximum number of video chunks downloaded at the same time across all uploads.', type=int, required=False )
+	parser.add_argument( '--recorded-after', help='When in channel mode process only recordings made after this time, for example 2016-01-31T00:00:00Z.', required=False )
+	parser.add_argument( '--upload-session-file', help='File in which unfinished Youtube upload sessions and the uploaded parts of followed videos are kept so they can be continued after errors and restarts.', required=False )
+	parser.add_argument( '--upload-chunk-size', help='Upload videos in chunks of this many bytes, a multiple of 262144. -1 uploads in a single request.', type=int, default=-1 )
+	parser.add_argument( '--adaptive-chunk-size', help='Tune the upload chunk size to the measured upload speed.', action='store_true' )
+	parser.add_argument( '--metrics-port', help='Serve metrics in the Prometheus text format on this port.', type=int, required=False )
+	parser.add_argument( '--metrics-file', help='Periodically append metrics as a json line to this file.', required=False )
+	parser.add_argument( '--metrics-interval', help='Seconds between lines in the metrics file.', type=float, default=60 )
+	parser.add_argument( '--dry-run', help='Only print how videos would be split into parts, do not upload anything.', action='store_true' )
+	parser.add_argument( '--pool-hosts', help='Number of hosts HTTP connections are kept open for.', type=int, default=16 )
+	parser.add_argument( '--pool-size', help='Maximum number of HTTP connections kept open per host.', type=int, default=32 )
+	parser.add_argument( '--pool-block', help='Wait for a free connection instead of opening more than pool-size connections to a host.', action='store_true' )
+	parser.add_argument( '--no-keep-alive', help='Close HTTP connections after every request.', action='store_true' )
+	parser.add_argument( '--http2', help='Use HTTP/2 where possible, needs the httpx package.', action='store_true' )
+	parser.add_argument( '--follow', help='Upload videos that are still recording part by part while they grow instead of skipping them.', action='store_true' )
+	parser.add_argument( '--follow-interval', help='Seconds between checks for new segments of a video that is still recording.', type=float, default=60 )
+	parser.add_argument( '--job-queue', help='File of the job queue that keeps the progress of the daemon mode.', default='twitch_jobs.sqlite' )
+	parser.add_argument( '--poll-interval', help='In daemon mode, seconds between checks for new videos.', type=float, default=15*60 )
+	parser.add_argument( '--max-attempts', help='In daemon mode, number of times uploading a video is tried before it is marked as failed.', type=int, default=3 )
+	parser.add_argument( '--retry-failed', help='In daemon mode, queue videos that failed before again on start.', action='store_true' )
+	parser.add_argument( '--async-backend', help='Download all videos on one asyncio event loop instead of a thread per transfer, needs the aiohttp package. Does not support --bandwidth-limit.', action='store_true' )
+	parser.add_argument( '--retry-max-delay', help='Longest wait in seconds between retries of a failed Twitch request.', type=float, default=60.0 )
 	args = parser.parse_args()
 
 	headers_v3['Client-ID'] = args.client_id
+	retry.default_policy = retry.RetryPolicy(max_delay=args.retry_max_delay, breaker=retry.CircuitBreaker())
+	http_pool.configure(args.pool_hosts, args.pool_size, args.pool_block, not args.no_keep_alive, args.http2)
+	if args.index_cache:
+		index_store = IndexStore(args.index_cache)
+	if args.bandwidth_limit:
+		bandwidth_limiter = BandwidthLimiter(args.bandwidth_limit)
+	if args.metrics_port:
+		metrics.serve_prometheus(args.metrics_port)
+	if args.metrics_file:
+		metrics.write_json_lines(args.metrics_file, args.metrics_interval)
+	if args.upload_session_file:
+		upload_session_store = UploadSessionStore(args.upload_session_file)
+	if args.max_downloads:
+		download_slots = threading.BoundedSemaphore(args.max_downloads)
+	if args.async_backend:
+		try:
+			from AsyncTwitchIO import EventLoopThread, SyncTwitchIO
+			event_loop_thread = EventLoopThread(args.pool_hosts * args.pool_size, args.pool_size, args.max_downloads)
+		except ImportError:
+			print('The async backend needs the aiohttp package, using the blocking one.')
 
 	youtube_uploader = YoutubeUploader(args.authentication_file, args.client_secrets_file)
 
@@ -153,13 +516,28 @@ if __name__ == "__main__":
 				start_after = state_file.readline().rstrip('\n')
 		else:
 			start_after = args.start_after
-		videos = get_videos( args.destination_id, start_after )
+		videos = get_videos( args.destination_id, start_after, args.recorded_after, include_recording=args.follow )
 		videos.reverse()
+		selected_videos = []
 		for video in videos:
 			if args.game_filter == None or video['game'] == args.game_filter:
-				process_single_video( video, youtube_uploader, args )
+				selected_videos.append( video )
 			else:
 				print('Skipping', video['id'], 'because it does not match game.')
+		if args.workers > 1:
+			process_videos( selected_videos, args )
+		else:
+			for video in selected_videos:
+				process_single_video( video, youtube_uploader, args )
 	elif args.upload_type == 'video':
 		video = get_video( args.destination_id )
 		process_single_video( video, youtube_uploader, args )
+	elif args.upload_type == 'daemon':
+		job_queue = JobQueue(args.job_queue, args.max_attempts)
+		if args.retry_failed:
+			job_queue.retry_failed()
+		if run_daemon( job_queue, args ):
+			job_queue.close()
+	print('HTTP connection statistics {}.'.format(http_pool.stats()))
+	if event_loop_thread is not None:
+		event_loop_thread.close()
@@ -1,76 +1,125 @@
 import logging
 import os
-import requests
-import time
-from random import random
-import m3u8
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from TwitchIO import TwitchIO
+# Re-exported so callers of the old twitch_downloader playlist functions keep working
+from twitch_playlist import get_session, get_variant_playlist, get_source_playlist
 
 
-twitch_api_url = "https://api.twitch.tv"
-twitch_usher_url = "http://usher.twitch.tv"
+def write_at(file, data, offset):
+	# Write all of data to file at offset without moving the file position if the platform allows it
+	if hasattr(os, 'pwrite'):
+		view = memoryview(data)
+		while len(view) > 0:
+			written = os.pwrite(file.fileno(), view, offset)
+			view = view[written:]
+			offset += written
+	else:
+		file.seek(offset)
+		file.write(data)
 
-def get_session(video_id, headers=dict()):
-	r = requests.get(twitch_api_url + "/api/vods/{}/access_token".format(video_id), headers=headers)
-	logging.debug("get_session for video_id {} got data {}".format(video_id, r.content))
-	json = r.json()
-	return (json['token'], json['sig'])
+def read_journal(journal_filename, header, file):
+	# Return the number of segments at the start of file that the journal records as complete
+	# and whose data on disk still matches the recorded checksum, together with their journal entries.
+	# The journal starts with a header line describing the video followed by one line
+	# 'index end_offset crc32' per segment written in order.
+	try:
+		with open(journal_filename, 'r') as journal:
+			lines = journal.read().split('\n')
+	except OSError:
+		return 0, list()
+	if lines[0] != header:
+		logging.info('Journal {} belongs to a different video, starting over'.format(journal_filename))
+		return 0, list()
+	entries = list()
+	for line in lines[1:]:
+		try:
+			index, end, checksum = (int(i) for i in line.split(' '))
+		except ValueError:
+			break # a partially written last line
+		if index != len(entries):
+			break
+		entries.append((end, checksum))
+	file_size = os.fstat(file.fileno()).st_size
+	# Check the tail of the file, going back until a segment is intact
+	while len(entries) > 0:
+		end, checksum = entries[-1]
+		start = entries[-2][0] if len(entries) > 1 else 0
+		if end <= file_size:
+			file.seek(start)
+			if zlib.crc32(file.read(end - start)) == checksum:
+				break
+		logging.info('Segment {} in {} is incomplete and will be downloaded again'.format(len(entries) - 1, file.name))
+		entries.pop()
+	return len(entries), entries
 
-def get_variant_playlist(video_id, headers=dict()):
-	token, sig = get_session(video_id, headers)
-	params = {
-		"player": "twitchweb",
-		"p": int(random() * 999999),
-		"type": "any",
-		"allow_source": "true",
-		"allow_audio_only": "true",
-		"nauth": token,
-		"nauthsig": sig }
-
-	r = requests.get(twitch_usher_url + "/vod/{}".format(video_id), params=params)
-	r.encoding = 'utf-8'
-	logging.debug('get_variant_playlist for video_id {} got data {}'.format(video_id, r.content))
-	#Some playlists have bandwidth set to none which is not valid m3u8 and will crash the parser
-	#we dont care about the value so fix it by setting it something
-	text = r.text.replace(',BANDWIDTH=None,', ',BANDWIDTH=1,')
-	return m3u8.loads(text)
-
-def get_source_playlist(video_id, headers=dict()):
-	variant_playlist = get_variant_playlist(video_id, headers)
-	for playlist in variant_playlist.playlists:
-		for media in playlist.media:
-			if media.group_id == 'chunked': # Corresponds to Source quality
-				uri = playlist.uri
-				base_path = playlist.uri[:playlist.uri.rfind('/')]
-				r = requests.get(uri)
-				r.encoding = 'utf-8'
-				logging.info('get_source_playlist found source playlist for video_id {} at {}'.format(video_id, playlist.uri))
-				logging.debug('get_source_playlist source playlist data is {}'.format(r.content))
-				playlist = m3u8.M3U8(content=r.text, base_path=base_path)
-				return playlist
-
-def download_video(video_id, filename, chunk_size = 2**20, timeout=12.1, callback_progress_update=None):
-	'''	video_id is just a string of numbers and does not start with a v'''
+def download_video(video_id, filename, chunk_size = 2**20, timeout=12.1, callback_progress_update=None, headers=dict(), workers=4, max_buffer=256*2**20, resume=False):
+	'''	video_id is just a string of numbers and does not start with a v
+	Up to workers segments are downloaded at the same time. They are written to the file in order
+	at their offset in the video, segments that finish early wait in memory until it is their turn.
+	At most max_buffer bytes of segments are downloading or waiting at the same time.
+	callback_progress_update is called with the number of bytes written so far after every chunk_size bytes.
+	If resume is True completed segments are recorded in a journal next to the file and a download
+	that was interrupted continues from the first incomplete segment. The journal is removed when done.'''
 	logging.info('Downloading video {} as  {}'.format(video_id, filename))
-	with open(filename, 'wb') as file, requests.Session() as session:
-		segments = get_source_playlist(video_id).segments.uri
-		for segment in segments:
-			logging.debug('download_video is now now downloading segment {}'.format(segment))
-			while True: # Keep trying to download the segment until success
-				written_bytes_segment = 0
-				try:
-					r = session.get(segment, stream=True, timeout=timeout)
-					for content in r.iter_content(chunk_size=chunk_size):
-						logging.debug('download_video finished downloading a chunk')
-						file.write(content)
-						written_bytes_segment += len(content)
-						if callback_progress_update is not None:
-							callback_progress_update(file.tell())
-					break
-				except requests.exceptions.RequestException as e:
-					logging.warning('download_video encountered the following exception while trying to download segment {} {}'.format(segment, e))
-					logging.info('will retry download after {} seconds'.format(timeout))
-					if written_bytes_segment > 0: # Remove what was written from this segment so we do not write it multiple times when retrying
-						file.seek(file.tell() - written_bytes_segment)
-						file.truncate()
-					time.sleep(timeout)
-					continue
+	twitchio = TwitchIO(get_source_playlist(video_id, headers).segments, timeout=timeout)
+	count = len(twitchio.segments)
+	journal_filename = filename + '.journal'
+	header = 'video {} segments {} size {}'.format(video_id, count, twitchio.size)
+	first = 0
+	entries = list()
+	mode = 'wb'
+	if resume and os.path.exists(filename):
+		mode = 'r+b'
+	with open(filename, mode) as file, ThreadPoolExecutor(max_workers=workers) as executor:
+		if mode == 'r+b':
+			first, entries = read_journal(journal_filename, header, file)
+			logging.info('Resuming download of video {} at segment {} of {}'.format(video_id, first, count))
+		if os.fstat(file.fileno()).st_size != twitchio.size:
+			file.truncate(twitchio.size)
+		# Reserve the space for the whole video up front
+		if hasattr(os, 'posix_fallocate') and twitchio.size > 0:
+			os.posix_fallocate(file.fileno(), 0, twitchio.size)
+		journal = None
+		if resume:
+			# Rewrite the journal with only the entries that were verified
+			journal = open(journal_filename, 'w')
+			journal.write(header + '\n')
+			for index, (end, checksum) in enumerate(entries):
+				journal.write('{} {} {}\n'.format(index, end, checksum))
+			journal.flush()
+		if first > 0 and callback_progress_update is not None:
+			callback_progress_update(twitchio.offset_index[first - 1])
+		pending = dict()
+		pending_bytes = 0
+		next_submit = first
+		try:
+			for index in range(first, count):
+				while next_submit < count:
+					size = twitchio.get_chunk_size(next_submit)
+					if len(pending) > 0 and pending_bytes + size > max_buffer:
+						break
+					logging.debug('download_video is now downloading segment {}'.format(twitchio.segments[next_submit].uri))
+					pending[next_submit] = executor.submit(twitchio.download_chunk, next_submit)
+					pending_bytes += size
+					next_submit += 1
+				content = pending.pop(index).result()
+				pending_bytes -= twitchio.get_chunk_size(index)
+				offset = twitchio.offset_index[index - 1] if index > 0 else 0
+				for position in range(0, len(content), chunk_size):
+					part = memoryview(content)[position:position + chunk_size]
+					write_at(file, part, offset + position)
+					if callback_progress_update is not None:
+						callback_progress_update(offset + position + len(part))
+				if journal is not None:
+					journal.write('{} {} {}\n'.format(index, offset + len(content), zlib.crc32(content)))
+					journal.flush()
+		except BaseException:
+			# Do not wait for the queued downloads before the error is raised
+			for future in pending.values():
+				future.cancel()
+			raise
+		if journal is not None:
+			journal.close()
+			os.remove(journal_filename)
@@ -0,0 +1,64 @@
+# Access token and playlists of Twitch videos
+
+import logging
+from random import random
+import m3u8
+import http_pool
+
+
+twitch_api_url = "https://api.twitch.tv"
+twitch_usher_url = "http://usher.twitch.tv"
+
+def get_session(video_id, headers=dict()):
+	r = http_pool.shared_session().get(twitch_api_url + "/api/vods/{}/access_token".format(video_id), headers=headers)
+	r.raise_for_status()
+	logging.debug("get_session for video_id {} got data {}".format(video_id, r.content))
+	json = r.json()
+	return (json['token'], json['sig'])
+
+def variant_playlist_params(token, sig):
+	return {
+		"player": "twitchweb",
+		"p": int(random() * 999999),
+		"type": "any",
+		"allow_source": "true",
+		"allow_audio_only": "true",
+		"nauth": token,
+		"nauthsig": sig }
+
+def parse_variant_playlist(text):
+	#Some playlists have bandwidth set to none which is not valid m3u8 and will crash the parser
+	#we dont care about the value so fix it by setting it something
+	text = text.replace(',BANDWIDTH=None,', ',BANDWIDTH=1,')
+	return m3u8.loads(text)
+
+def source_playlist_uri(variant_playlist):
+	# Return the uri of the source quality playlist or None
+	for playlist in variant_playlist.playlists:
+		for media in playlist.media:
+			if media.group_id == 'chunked': # Corresponds to Source quality
+				return playlist.uri
+	return None
+
+def parse_source_playlist(text, uri):
+	return m3u8.M3U8(content=text, base_path=uri[:uri.rfind('/')])
+
+def get_variant_playlist(video_id, headers=dict()):
+	token, sig = get_session(video_id, headers)
+	r = http_pool.shared_session().get(twitch_usher_url + "/vod/{}".format(video_id), params=variant_playlist_params(token, sig))
+	r.raise_for_status()
+	r.encoding = 'utf-8'
+	logging.debug('get_variant_playlist for video_id {} got data {}'.format(video_id, r.content))
+	return parse_variant_playlist(r.text)
+
+def get_source_playlist(video_id, headers=dict()):
+	variant_playlist = get_variant_playlist(video_id, headers)
+	uri = source_playlist_uri(variant_playlist)
+	if uri is None:
+		return None
+	r = http_pool.shared_session().get(uri)
+	r.raise_for_status()
+	r.encoding = 'utf-8'
+	logging.info('get_source_playlist found source playlist for video_id {} at {}'.format(video_id, uri))
+	logging.debug('get_source_playlist source playlist data is {}'.format(r.content))
+	return parse_source_playlist(r.text, uri)
@@ -2,19 +2,158 @@ import random
 import time
 import httplib2
 import logging
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from apiclient.discovery import build
 from apiclient.errors import HttpError
-from apiclient.http import MediaFileUpload, MediaIoBaseUpload
+from apiclient.http import MediaFileUpload, MediaIoBaseUpload, MediaUpload
 from oauth2client.client import flow_from_clientsecrets
 from oauth2client.file import Storage
 from oauth2client.tools import argparser, run_flow
 
+import metrics
+
 httplib2.RETRIES = 1
 
 
 VALID_PRIVACY_STATUSES = ("public", "private", "unlisted")
 
+# Remembers the session uri and the confirmed progress of resumable uploads in a json file
+# so an upload that failed, even in an earlier run of the program, continues where it stopped
+# instead of starting again from the first byte.
+# Youtube keeps upload sessions for about a week, older entries are ignored.
+class UploadSessionStore:
+	def __init__(self, filename, max_age=6*24*60*60):
+		self.filename = filename
+		self.max_age = max_age
+		self.lock = threading.Lock()
+		try:
+			with open(filename, 'r') as file:
+				self.sessions = json.load(file)
+		except (OSError, ValueError):
+			self.sessions = dict()
+	def get(self, key):
+		with self.lock:
+			session = self.sessions.get(key)
+		if session is None or time.time() - session['created'] > self.max_age:
+			return None
+		return session
+	def put(self, key, uri, progress):
+		with self.lock:
+			session = self.sessions.get(key)
+			if session is None or session['uri'] != uri:
+				session = dict(uri=uri, created=time.time())
+				self.sessions[key] = session
+			session['progress'] = progress
+			self.save()
+	def update(self, key, **values):
+		# Keep other progress that has to survive restarts, like the parts of a followed video, under key
+		with self.lock:
+			session = self.sessions.setdefault(key, dict(created=time.time()))
+			session.update(values)
+			self.save()
+	def remove(self, key):
+		with self.lock:
+			if self.sessions.pop(key, None) is not None:
+				self.save()
+	def save(self):
+		# Write to a temporary file first so a crash can not leave a half written file behind
+		temporary_filename = self.filename + '.tmp'
+		with open(temporary_filename, 'w') as file:
+			json.dump(self.sessions, file)
+		os.replace(temporary_filename, self.filename)
+
+# Media body that uploads an IOBase in chunks and reads the next chunk on a background thread
+# while the current one is being sent, so reading from Twitch overlaps with writing to Youtube.
+# If adaptive is True the chunk size is tuned after every chunk so that sending one takes about
+# target_seconds at the measured throughput, and halved after a failed chunk so less is lost on errors.
+# Youtube needs every chunk except the last one to be a multiple of 256 KiB.
+# chunk_timings has an entry per chunk with its offset, size, seconds spent waiting for the data,
+# seconds spent sending it and whether it failed.
+class PipelinedMediaUpload(MediaUpload):
+	granularity = 256 * 1024
+	def __init__(self, iobase, chunksize=32*2**20, adaptive=False, min_chunksize=4*2**20, max_chunksize=512*2**20, target_seconds=30.0, mimetype='application/octet-stream'):
+		self.iobase = iobase
+		self._mimetype = mimetype
+		self.adaptive = adaptive
+		self.min_chunksize = min_chunksize
+		self.max_chunksize = max_chunksize
+		self.target_seconds = target_seconds
+		self._chunksize = self.round_chunksize(chunksize)
+		iobase.seek(0, os.SEEK_END)
+		self._size = iobase.tell()
+		self.lock = threading.Lock()
+		self.executor = ThreadPoolExecutor(max_workers=1)
+		# (begin, future) of the chunk being read in the background
+		self.next = None
+		self.last_read_seconds = 0.0
+		self.chunk_timings = list()
+	def round_chunksize(self, chunksize):
+		# min_chunksize and max_chunksize only bound the sizes chosen in adaptive mode
+		chunksize = int(chunksize)
+		if self.adaptive:
+			chunksize = max(self.min_chunksize, min(self.max_chunksize, chunksize))
+		return max(self.granularity, chunksize - chunksize % self.granularity)
+	def chunksize(self):
+		return self._chunksize
+	def mimetype(self):
+		return self._mimetype
+	def size(self):
+		return self._size
+	def resumable(self):
+		return True
+	def has_stream(self):
+		return False
+	def read(self, begin, length):
+		with self.lock:
+			self.iobase.seek(begin)
+			return self.iobase.read(length)
+	def getbytes(self, begin, length):
+		start = time.monotonic()
+		data = None
+		if self.next is not None:
+			next_begin, future = self.next
+			self.next = None
+			if next_begin == begin:
+				data = future.result()
+			else:
+				future.cancel()
+		if data is None:
+			data = self.read(begin, length)
+		elif len(data) > length:
+			data = data[:length]
+		elif len(data) < length and begin + len(data) < self._size:
+			# the chunk size grew since the read was started
+			data += self.read(begin + len(data), length - len(data))
+		self.last_read_seconds = time.monotonic() - start
+		end = begin + len(data)
+		if end < self._size:
+			self.next = (end, self.executor.submit(self.read, end, self._chunksize))
+		return data
+	def record_chunk(self, begin, end, seconds, error=False):
+		# Called by the uploader after every attempt to send a chunk, seconds includes waiting for getbytes
+		send_seconds = max(seconds - self.last_read_seconds, 1e-6)
+		self.chunk_timings.append(dict(
+			offset=begin,
+			bytes=end - begin,
+			read_seconds=self.last_read_seconds,
+			send_seconds=send_seconds,
+			error=error))
+		if not self.adaptive:
+			return
+		if error:
+			self._chunksize = self.round_chunksize(self._chunksize // 2)
+		elif end - begin >= self._chunksize:
+			# Only full chunks say something about the throughput, move halfway towards the target
+			target = (end - begin) / send_seconds * self.target_seconds
+			self._chunksize = self.round_chunksize((self._chunksize + target) / 2)
+		logging.debug('Upload chunk size is now {}'.format(self._chunksize))
+	def close(self):
+		self.executor.shutdown(wait=False)
+
 class YoutubeUploader:
 	def __init__(self, auth_file, client_secrets_file=None):
 		YOUTUBE_UPLOAD_SCOPE = "https://www.googleapis.com/auth/youtube"
@@ -63,10 +202,20 @@ class YoutubeUploader:
 		return response
 	def file_to_media_body(filename):
 		return MediaFileUpload(filename, chunksize=-1, resumable=True)
-	def iobase_to_media_body(iobase):
-		return MediaIoBaseUpload(iobase, mimetype='application/octet-stream', chunksize=-1, resumable=True)
-	def upload(self, media_body, title=None, description=None, category=None, tags=None, privacyStatus="private"):
+	def iobase_to_media_body(iobase, chunksize=-1, adaptive=False):
+		# chunksize -1 sends everything in one request, otherwise a PipelinedMediaUpload is used
+		if chunksize == -1 and not adaptive:
+			return MediaIoBaseUpload(iobase, mimetype='application/octet-stream', chunksize=-1, resumable=True)
+		if chunksize == -1:
+			return PipelinedMediaUpload(iobase, adaptive=adaptive)
+		return PipelinedMediaUpload(iobase, chunksize, adaptive)
+	def upload(self, media_body, title=None, description=None, category=None, tags=None, privacyStatus="private", session_store=None, session_key=None):
+		# If session_store and session_key are given the upload session is saved in the UploadSessionStore
+		# and a saved session for the same key and size is continued instead of starting a new upload.
 		assert(privacyStatus in ["public", "private", "unlisted"])
+		if session_store is not None:
+			assert session_key is not None, "session_store needs a session_key"
+			session_key = '{} {}'.format(session_key, media_body.size())
 		def shorten_str_to_bytes(max_bytes, string):
 			while len(string.encode()) > max_bytes:
 				string = string[:-1]
@@ -103,12 +252,43 @@ class YoutubeUploader:
 				body=body,
 				media_body=media_body)
 
+			session = session_store.get(session_key) if session_store is not None else None
+			if session is not None:
+				print('Continuing saved upload session after byte {}'.format(session['progress']))
+				insert_request.resumable_uri = session['uri']
+				insert_request.resumable_progress = session['progress']
+				# Makes the client ask Youtube how many bytes it has before sending more,
+				# the media body is then seeked to that offset.
+				# _in_error_state is private state of googleapiclient's HttpRequest, check it still exists
+				# and means the same when upgrading the library.
+				insert_request._in_error_state = True
+
 			response = None
 			error = None
 			retry = 0
 			while response is None:
 				try:
-					status, response = insert_request.next_chunk()
+					begin = insert_request.resumable_progress
+					start = time.monotonic()
+					try:
+						status, response = insert_request.next_chunk()
+					except Exception:
+						metrics.registry.increment('youtube_chunk_errors_total')
+						if hasattr(media_body, 'record_chunk'):
+							media_body.record_chunk(begin, begin, time.monotonic() - start, error=True)
+						raise
+					finally:
+						if session_store is not None and insert_request.resumable_uri is not None:
+							session_store.put(session_key, insert_request.resumable_uri, insert_request.resumable_progress)
+					elapsed = time.monotonic() - start
+					end = media_body.size() if response is not None else insert_request.resumable_progress
+					metrics.registry.observe('youtube_chunk_seconds', elapsed)
+					metrics.registry.increment('youtube_uploaded_bytes_total', end - begin)
+					metrics.registry.observe('youtube_chunk_bytes_per_second', (end - begin) / max(elapsed, 1e-6))
+					if hasattr(media_body, 'record_chunk'):
+						media_body.record_chunk(begin, end, elapsed)
+					if response is None:
+						continue
 					if 'id' in response:
 						print("Video id '%s' was successfully uploaded." % response['id'])
 						return response["id"]
@@ -117,6 +297,10 @@ class YoutubeUploader:
 				except HttpError as e:
 					if e.resp.status in [500, 502, 503, 504]:
 						error = "A retriable HTTP error %d occurred:\n%s" % (e.resp.status, e.content)
+					elif session is not None and e.resp.status in [404, 410]:
+						print("Saved upload session is not valid anymore, a new one will be started")
+						session_store.remove(session_key)
+						raise
 					else:
 						raise
 				except httplib2.HttpLib2Error as e:
@@ -134,14 +318,21 @@ class YoutubeUploader:
 				time.sleep(sleep_seconds)
 
 		result = None
-		while result is None: #Retry the whole upload until True is returned
-			try:
-				print('debug starting upload')
-				result = upload_process()
-			except (HttpError, ConnectionError) as e:
-				print("Unretriable error occured while uploading:")
-				print(e)
-				print("retrying in 60 seconsd")
-				time.sleep(60)
+		try:
+			while result is None: #Retry the whole upload until True is returned
+				try:
+					print('debug starting upload')
+					result = upload_process()
+				except (HttpError, ConnectionError) as e:
+					print("Unretriable error occured while uploading:")
+					print(e)
+					print("retrying in 60 seconsd")
+					time.sleep(60)
+		finally:
+			# stops the read ahead thread of a PipelinedMediaUpload also when the upload fails
+			if hasattr(media_body, 'close'):
+				media_body.close()
+		if session_store is not None:
+			session_store.remove(session_key)
 		print("Finished upload with id %s" % result)
 		return result